@@ -1,167 +1,1416 @@
 import os
 import gc
+import re
+import json
 import time
+import queue
+import threading
 import subprocess
-import csv
-import torch
+import multiprocessing
+import cv2
+import numpy as np
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from ultralytics import YOLO
 from datetime import datetime
+from log_writer import BatchedCsvWriter
+import storage
+import metrics
+import states
+import inference_pool
+import retention
+import model_cache
+
+# Inference batching (frames from all cameras share one model call)
+INFERENCE_BATCH_SIZE = 8  # max frames per model call
+INFERENCE_MAX_WAIT = 0.05  # seconds to wait for a batch to fill before running it
+INFERENCE_QUEUE_SIZE = 64  # frames waiting for a batch before JPEG-mode cameras block and pipe-mode cameras drop frames (each holds a decoded frame)
+INFERENCE_WORKERS = 0  # >0 runs inference in this many worker processes, each pinned to a share of the cores (CPU hosts)
+INFERENCE_POOL_INFLIGHT = 2  # batches queued per worker before dispatch waits
+INFERENCE_POOL_RESTARTS = 3  # times a worker that died is restarted before it is retired
+MODEL_PATH = "/home/.../best.pt"
+BASE_DIR = "/home/..."  # frames and logs go to {BASE_DIR}/{YYYYmmdd}_Animal, a new directory every day
+
+# Cameras: CAMERA_CONFIG_FILE ({"1": {"rtsp_url": ..., "suffix": ...}, ...}) is re-read whenever it changes,
+# cameras added, removed or edited there are started, stopped or restarted without touching the others.
+# CAMERAS is used when the file doesn't exist.
+CAMERA_CONFIG_FILE = "/home/.../cameras.json"
+CAMERAS = {
+        1: {"rtsp_url": "rtsp://...", "suffix": "#"},
+        2: {.....}
+}
+SUPERVISOR_CHECK_INTERVAL = 5  # seconds between checks for config changes and the date change
+
+# Capture mode: "jpeg" has ffmpeg write one JPEG per frame that a watchdog Observer picks up,
+# "pipe" has ffmpeg stream raw bgr24 frames to stdout which are handed straight to the detector
+CAPTURE_MODE = "jpeg"
+FRAME_RATE = 1  # frames per second sampled from each stream, or any another interval
+PIPE_FRAME_WIDTH = 1280  # pipe mode scales every stream to a fixed size so frames can be sliced from stdout
+PIPE_FRAME_HEIGHT = 720
+PIPE_SAVE_JPEG = False  # pipe mode only: also save each frame as a JPEG (side output, not used for detection)
+# Motion gating: skip inference on frames nearly identical to the last inferred one and reuse its detections
+MOTION_GATE_ENABLED = True
+MOTION_GATE_SIZE = (64, 36)  # frames are compared as grayscale thumbnails of this size
+MOTION_GATE_THRESHOLD = 2.0  # mean absolute pixel difference (0-255) at or below which a frame counts as unchanged
+MOTION_GATE_FORCE_INTERVAL = 30  # re-run inference after this many skipped frames in a row regardless
+# JPEG mode frame discovery: frames are taken when complete (file closed or renamed), in frame number order.
+# A per-camera cursor (next frame number, saved in the camera directory) replaces a set of seen paths.
+INGEST_SCAN_INTERVAL = 2  # seconds between scans at the cursor for frames whose events were lost
+INGEST_SETTLE_SECONDS = 2  # the newest frame without a close event is taken once unchanged for this long
+INGEST_MAX_GAP = 20  # missing frame numbers the scan skips when a later frame exists
+INGEST_CURSOR_FILE = ".frame_cursor.json"
+INGEST_CAPTURE_DIR = "capture"  # ffmpeg writes into this subdirectory; kept frames are moved up and renamed, the rest deleted
+RETENTION_ENABLED = True  # delete old frames and labels in the background (budgets in retention.py)
+PACK_LABELS = False  # append labels to one file per camera per hour (labels/YYYYmmdd_HH.labels) instead of a .txt per frame
+# Adaptive sampling: ffmpeg captures every camera at CAPTURE_FRAME_RATE and each camera keeps every n-th frame,
+# n following the animal's state on it (states.determine_animal_state) and the inference backlog. A rate change
+# applies from the next frame without reconnecting; kept frames are numbered consecutively.
+ADAPTIVE_FRAME_RATE = True  # False keeps every camera at FRAME_RATE
+FRAME_RATE_WALK = 2  # fps while the animal walks on an active camera
+FRAME_RATE_REST = 1  # fps while the animal rests on an active camera
+FRAME_RATE_IDLE = 0.2  # fps with no animal on the camera, and on passive cameras
+ACTIVITY_HOLD_SECONDS = 30  # a camera keeps its walk/rest rate this long after the animal was last seen on it
+BACKLOG_THROTTLE_FRAMES = 16  # above this many frames waiting for inference every rate is halved (not below FRAME_RATE_IDLE)
+RATE_HOLD_SECONDS = 15  # minimum time between two rate changes of the same camera
+RATE_CHECK_INTERVAL = 1  # seconds between controller checks
+CAPTURE_FRAME_RATE = max(FRAME_RATE_WALK, FRAME_RATE_REST, FRAME_RATE_IDLE) if ADAPTIVE_FRAME_RATE else FRAME_RATE  # fps ffmpeg delivers
+
+METRICS_PORT = 9108  # local Prometheus endpoint (/metrics) for this process, None to disable
+PRINT_DETECTIONS = True  # per-frame console summary; measurable overhead with many cameras
+
+# Per-stage metrics, labelled by camera where it applies
+FRAMES_TOTAL = metrics.Counter("animal_frames_total", "Frames handled per camera by outcome (inferred, reused, unreadable, error, dropped)", ["camera", "outcome"])
+FRAME_ARRIVAL_SECONDS = metrics.Histogram("animal_frame_arrival_seconds", "Delay between a frame file being written and it being picked up", ["camera"])
+INFERENCE_QUEUE_WAIT_SECONDS = metrics.Histogram("animal_inference_queue_wait_seconds", "Time a frame waits for its inference batch", ["camera"])
+INFERENCE_SECONDS = metrics.Histogram("animal_inference_seconds", "Duration of one (batched) model call")
+INFERENCE_BATCH_FRAMES = metrics.Histogram("animal_inference_batch_frames", "Frames per model call", buckets=(1, 2, 4, 8, 16, 32, 64))
+LABEL_WRITE_SECONDS = metrics.Histogram("animal_label_write_seconds", "Time to write one label file", ["camera"])
+LOG_APPEND_SECONDS = metrics.Histogram("animal_log_append_seconds", "Time to hand one frame's detections to the log writers", ["camera"])
+CAMERA_FRAME_RATE = metrics.Gauge("animal_camera_frame_rate", "Frames per second currently sampled from each camera", ["camera"])
+CAMERA_RESTARTS_TOTAL = metrics.Counter("animal_camera_restarts_total", "ffmpeg restarts to change the day directory (JPEG mode)", ["camera"])
+FRAMES_RECOVERED_TOTAL = metrics.Counter("animal_frames_recovered_total", "Frames picked up by the scan or a later frame's event instead of their own event", ["camera"])
+FRAME_NUMBERS_SKIPPED_TOTAL = metrics.Counter("animal_frame_numbers_skipped_total", "Frame numbers skipped because no file was ever written", ["camera"])
+INFERENCE_QUEUE_DEPTH = metrics.Gauge("animal_inference_queue_depth", "Frames queued for the inference scheduler")
+BACKLOG_FRAMES = metrics.Gauge("animal_backlog_frames", "Frames submitted for inference but not yet handed over", ["camera"])
+INGEST_LAG_FRAMES = metrics.Gauge("animal_ingest_lag_frames", "Captured JPEG frames on disk the camera's ingest cursor has not reached yet", ["camera"])
+
+# Memory cleanup: gc.collect() and torch.cuda.empty_cache() run only when a threshold is crossed
+CLEANUP_EVERY_N_FRAMES = 500  # clean up at least once per this many inferred frames
+CLEANUP_MIN_FRAMES = 20  # never clean up more often than this, even above a watermark
+CLEANUP_RSS_WATERMARK_MB = 2048  # clean up when resident memory of the process goes above this
+CLEANUP_CUDA_WATERMARK_MB = 1024  # clean up when memory reserved by the CUDA caching allocator goes above this
+
+def get_rss_mb():
+    """Current resident memory of this process in MB (Linux), or None if unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+def get_cuda_reserved_mb():
+    if not model_cache.gpu_available():
+        return None
+    import torch
+    return torch.cuda.memory_reserved() / 2**20
+
+class MemoryCleanup:
+    """
+    Decides when to collect Python garbage and release the CUDA cache instead
+    of doing it after every frame: every N frames, or when RSS / CUDA memory
+    crosses a watermark. Each run records how long it took and what it freed.
+    """
+    def __init__(self, every_n_frames=CLEANUP_EVERY_N_FRAMES, min_frames=CLEANUP_MIN_FRAMES,
+                 rss_watermark_mb=CLEANUP_RSS_WATERMARK_MB, cuda_watermark_mb=CLEANUP_CUDA_WATERMARK_MB):
+        self.every_n_frames = every_n_frames
+        self.min_frames = min_frames
+        self.rss_watermark_mb = rss_watermark_mb
+        self.cuda_watermark_mb = cuda_watermark_mb
+        self.lock = threading.Lock()
+        self.frames_since_cleanup = 0
+        self.runs = 0
+        self.total_seconds = 0.0
+        self.last_run = None
+
+    def frame_done(self, count=1):
+        """Call after frames have been inferred; runs a cleanup if one is due"""
+        with self.lock:
+            self.frames_since_cleanup += count
+            reason = self._due()
+            if reason is not None:
+                self._run(reason)
+
+    def _due(self):
+        if self.frames_since_cleanup >= self.every_n_frames:
+            return "frames"
+        if self.frames_since_cleanup < self.min_frames:
+            return None
+        rss = get_rss_mb()
+        if rss is not None and rss > self.rss_watermark_mb:
+            return "rss"
+        cuda = get_cuda_reserved_mb()
+        if cuda is not None and cuda > self.cuda_watermark_mb:
+            return "cuda"
+        return None
+
+    def _run(self, reason):
+        start = time.perf_counter()
+        rss_before = get_rss_mb()
+        cuda_before = get_cuda_reserved_mb()
+
+        collected = gc.collect() # This collects Python objects, releasing their memory if no longer referenced
+        if cuda_before is not None:
+            import torch
+            torch.cuda.empty_cache()
+
+        seconds = time.perf_counter() - start
+        rss_after = get_rss_mb()
+        cuda_after = get_cuda_reserved_mb()
+        self.frames_since_cleanup = 0
+        self.runs += 1
+        self.total_seconds += seconds
+        self.last_run = {
+            'reason': reason,
+            'seconds': seconds,
+            'objects_collected': collected,
+            'rss_freed_mb': None if rss_before is None or rss_after is None else rss_before - rss_after,
+            'cuda_freed_mb': None if cuda_before is None or cuda_after is None else cuda_before - cuda_after,
+        }
+        print(f"Memory cleanup ({reason}): {seconds * 1000:.1f} ms, {collected} objects collected, "
+              f"RSS freed {self.last_run['rss_freed_mb'] or 0:.1f} MB, CUDA freed {self.last_run['cuda_freed_mb'] or 0:.1f} MB")
+
+    def stats(self):
+        return {'runs': self.runs, 'total_seconds': self.total_seconds, 'last_run': self.last_run}
+
+memory_cleanup = MemoryCleanup() # Shared by every camera and the scheduler
+
+REUSE = object() # Submitted instead of a frame the motion gate found unchanged, see FrameHandler.deliver
+
+DETECTION_LOG_HEADER = ['timestamp', 'camera', 'filename', 'object_class', 'x_center', 'y_center', 'width', 'height']
 
 class DetectionLogger:
-    def __init__(self, log_dir):
+    def __init__(self, log_dir, listeners=None):
+        self.lock = threading.Lock() # Guards the writers while roll_over() replaces them
+        self.writer = None
+        self.store = None
+        self._open(log_dir)
+        # Callables that also receive every batch of logged rows (e.g. the in-process pipeline)
+        self.listeners = list(listeners or [])
+    
+    def _open(self, log_dir):
         self.log_dir = log_dir
         os.makedirs(log_dir, exist_ok=True)
         self.log_file = os.path.join(log_dir, "animal_detections_log.csv")
-        self._initialize_log()
-        
-    def _initialize_log(self):
-        if not os.path.exists(self.log_file):
-            with open(self.log_file, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(['timestamp', 'camera', 'filename', 'object_class', 'x_center', 'y_center'])
+        # One background writer per backend for all cameras: batched appends, no per-frame open/close
+        self.writer = None
+        self.store = None
+        if storage.STORAGE_BACKEND in ("csv", "both"):
+            self.writer = BatchedCsvWriter(self.log_file, header=DETECTION_LOG_HEADER)
+        if storage.STORAGE_BACKEND in ("sqlite", "both"):
+            self.store = storage.SqliteBatchWriter(storage.store_path(log_dir), 'detections')
+    
+    def roll_over(self, log_dir):
+        """Continue logging in log_dir (a new day); rows queued for the old log are written out first"""
+        with self.lock:
+            old_writer, old_store = self.writer, self.store
+            self._open(log_dir)
+        if old_writer is not None:
+            old_writer.close()
+        if old_store is not None:
+            old_store.close()
     
     def log_detection(self, timestamp, cam_num, filename, detection):
-        with open(self.log_file, 'a', newline='') as f:
-            writer = csv.writer(f)
-            for box in detection.boxes:
-                cls = int(box.cls.item())
-                xywhn = box.xywhn[0].tolist()
-                writer.writerow([
-                    timestamp,
-                    cam_num,
-                    filename,
-                    detection.names[cls],
-                    xywhn[0],
-                    xywhn[1],
-                ])
-
-class FrameHandler(FileSystemEventHandler):
-    def __init__(self, model, cam_num, logger):
+        rows = []
+        for box in detection.boxes:
+            cls = int(box.cls.item())
+            xywhn = box.xywhn[0].tolist()
+            rows.append([
+                timestamp,
+                cam_num,
+                filename,
+                detection.names[cls],
+                xywhn[0],
+                xywhn[1],
+                xywhn[2],
+                xywhn[3],
+            ])
+        with self.lock:
+            if self.writer is not None:
+                self.writer.write_rows(rows)
+            if self.store is not None:
+                self.store.write_rows([storage.detection_record(row) for row in rows])
+        for listener in self.listeners:
+            listener(rows)
+
+    def close(self):
+        """Write out any queued detections and close the log file"""
+        if self.writer is not None:
+            self.writer.close()
+        if self.store is not None:
+            self.store.close()
+
+class InferenceScheduler:
+    """
+    Collects pending frames from all cameras into micro-batches and runs
+    one batched model call per batch. Results are handed back to the
+    FrameHandler that submitted each frame. Instead of a model it can take
+    model_loader, which is called on the scheduler thread so the model loads
+    and warms up while the cameras connect; frames submitted meanwhile wait.
+    """
+    def __init__(self, model, batch_size=INFERENCE_BATCH_SIZE, max_wait=INFERENCE_MAX_WAIT, model_loader=None,
+                 queue_size=INFERENCE_QUEUE_SIZE):
+        self.model = model
+        self.model_loader = model_loader
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=queue_size) # submit() blocks when full, the cameras fall behind instead of memory growing
+        self.backlog = {} # camera -> frames submitted but not yet inferred
+        self.backlog_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # Sentinel lets the worker drain what is already queued before exiting
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, handler, frame_path, source=None):
+        # source is a decoded frame (numpy array) in pipe mode, REUSE for a frame that
+        # skips inference, otherwise the path itself is read by the model
+        self._update_backlog(handler.cam_num, 1)
+        self.queue.put((handler, frame_path, frame_path if source is None else source, time.perf_counter()))
+        INFERENCE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def full(self):
+        """True if submit() would block"""
+        return self.queue.full()
+
+    def pending(self):
+        """Frames submitted by all cameras that have not been inferred yet"""
+        with self.backlog_lock:
+            return sum(self.backlog.values())
+
+    def _update_backlog(self, cam_num, change):
+        with self.backlog_lock:
+            self.backlog[cam_num] = self.backlog.get(cam_num, 0) + change
+            BACKLOG_FRAMES.set(self.backlog[cam_num], camera=cam_num)
+
+    def _collect_batch(self):
+        """Block for the first frame, then gather more until the batch is full or max_wait expires"""
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        if self.model is None and self.model_loader is not None:
+            try:
+                self.model = self.model_loader()
+            except Exception as e:
+                print(f"Error loading model: {e}") # Every batch is then counted as an error
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect_batch()
+            if stopping:
+                # Drain anything submitted before stop() was called
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        batch.append(item)
+            for start in range(0, len(batch), self.batch_size):
+                self._run_batch(batch[start:start + self.batch_size])
+
+    def _batch_started(self, batch):
+        """Record queue wait and backlog for a batch that is about to run; returns its start time"""
+        start = time.perf_counter()
+        INFERENCE_QUEUE_DEPTH.set(self.queue.qsize())
+        for handler, _, _, submitted in batch:
+            INFERENCE_QUEUE_WAIT_SECONDS.observe(start - submitted, camera=handler.cam_num)
+            self._update_backlog(handler.cam_num, -1)
+        return start
+
+    def _run_batch(self, batch):
+        sources = [source for _, _, source, _ in batch if source is not REUSE]
+        start = self._batch_started(batch)
+        results = []
+        if sources:
+            try:
+                results = self.model(sources, batch=len(sources))
+                # if use desired classes change results for
+                # results = self.model(sources, batch=len(sources), classes=desired_classes)
+            except Exception as e:
+                print(f"Error running inference batch of {len(sources)} frames: {str(e)}")
+                results = [None] * len(sources)
+            finally:
+                INFERENCE_SECONDS.observe(time.perf_counter() - start)
+                INFERENCE_BATCH_FRAMES.observe(len(sources))
+                memory_cleanup.frame_done(len(sources))
+
+        # Reused frames are handed over in their place in the batch, after the frames before them
+        results = iter(results)
+        for handler, frame_path, source, _ in batch:
+            handler.deliver(frame_path, REUSE if source is REUSE else next(results))
+
+class InferencePool(InferenceScheduler):
+    """
+    InferenceScheduler that runs batches in worker processes instead of this
+    process, for CPU-only hosts where one process can't keep every core busy.
+    Each worker is pinned to its own share of the cores and loads the model
+    once (see inference_pool.py). JPEG frames are sent as paths, raw pipe
+    frames through shared memory blocks. Results come back as compact box
+    tuples and are handed to each camera's FrameHandler in submission order.
+    Every worker has its own task queue, so when one dies the batches it held
+    are known: they fail (every frame gets a None result) and the worker is
+    restarted, up to INFERENCE_POOL_RESTARTS times.
+    """
+    def __init__(self, model_path, workers=INFERENCE_WORKERS, batch_size=INFERENCE_BATCH_SIZE,
+                 max_wait=INFERENCE_MAX_WAIT, inflight_per_worker=INFERENCE_POOL_INFLIGHT, queue_size=INFERENCE_QUEUE_SIZE):
+        super().__init__(None, batch_size, max_wait, queue_size=queue_size)
+        self.model_path = model_path
+        self.core_shares = inference_pool.split_cores(workers)
+        self.context = multiprocessing.get_context("spawn") # fork is unsafe once torch has started threads
+        self.results = self.context.Queue()
+        self.workers = [None] * len(self.core_shares) # None once a worker is retired
+        self.task_queues = [None] * len(self.core_shares)
+        self.restarts = [0] * len(self.core_shares)
+        self.outstanding = [0] * len(self.core_shares) # batches dispatched to each worker and not finished
+        # Dispatch blocks while every worker already has this many batches, so the backlog stays visible in self.queue
+        self.inflight = threading.BoundedSemaphore(len(self.workers) * inflight_per_worker)
+        self.batches = {} # batch_id -> (batch, shared memory slots, dispatch time, worker)
+        self.batches_lock = threading.Condition()
+        self.next_batch_id = 0
+        self.free_slots = [] # FrameSlots returned by finished batches
+        self.next_sequence = {} # camera -> sequence number of the next dispatched frame
+        self.reorder = {} # camera -> [next sequence to hand over, {sequence: (handler, frame_path, result)}]
+        self.reorder_lock = threading.Lock() # Reused frames are handed over from the scheduler thread, results from the collector
+        self.stopping = False # Workers exit on purpose from here on
+        self.collector = threading.Thread(target=self._collect_results, name="inference-pool-results", daemon=True)
+
+    def _start_worker(self, i):
+        self.task_queues[i] = self.context.Queue()
+        self.workers[i] = self.context.Process(
+            target=inference_pool.worker_main,
+            args=(self.model_path, self.core_shares[i], self.task_queues[i], self.results, sorted({1, self.batch_size})),
+            name=f"inference-worker-{i}", daemon=True)
+        self.workers[i].start()
+
+    def start(self):
+        for i in range(len(self.workers)):
+            self._start_worker(i)
+        print(f"Inference pool: {len(self.workers)} workers on cores {self.core_shares}")
+        self.collector.start()
+        super().start()
+
+    def stop(self):
+        super().stop() # Every queued frame has been dispatched once this returns
+        with self.batches_lock:
+            while self.batches and self._workers_alive():
+                self.batches_lock.wait(timeout=1)
+            self.stopping = True
+        for tasks, worker in zip(self.task_queues, self.workers):
+            if worker is not None:
+                tasks.put(None)
+        for worker in self.workers:
+            if worker is not None:
+                worker.join()
+        self.results.put(None)
+        self.collector.join()
+        for slot in self.free_slots:
+            slot.release()
+
+    def _workers_alive(self):
+        return any(worker is not None and worker.is_alive() for worker in self.workers)
+
+    def _pick_worker(self):
+        """Running worker with the fewest batches in flight, or None (called with batches_lock held)"""
+        running = [i for i, worker in enumerate(self.workers) if worker is not None and worker.is_alive()]
+        return min(running, key=lambda i: self.outstanding[i], default=None)
+
+    def _take_slot(self, size):
+        for i, slot in enumerate(self.free_slots):
+            if slot.size >= size:
+                return self.free_slots.pop(i)
+        return inference_pool.FrameSlot(size)
+
+    def _run_batch(self, batch):
+        self._batch_started(batch)
+        inferred = [item for item in batch if item[2] is not REUSE]
+        acquired = False
+        while inferred and not acquired:
+            acquired = self.inflight.acquire(timeout=1)
+            if not acquired and not self._workers_alive():
+                break
+        items, slots = [], []
+        sequenced, reused = [], []
+        worker = None
+        with self.batches_lock:
+            if acquired:
+                worker = self._pick_worker()
+            for handler, frame_path, source, _ in batch:
+                sequence = self.next_sequence.get(handler.cam_num, 0)
+                self.next_sequence[handler.cam_num] = sequence + 1
+                if source is REUSE:
+                    reused.append((handler, frame_path, sequence))
+                    continue
+                sequenced.append((handler, frame_path, sequence))
+                if worker is None:
+                    continue
+                if isinstance(source, np.ndarray):
+                    slot = self._take_slot(source.nbytes)
+                    slots.append(slot)
+                    items.append(slot.write(source))
+                else:
+                    items.append(source)
+            if worker is not None:
+                batch_id = self.next_batch_id
+                self.next_batch_id += 1
+                self.batches[batch_id] = (sequenced, slots, time.perf_counter(), worker)
+                self.outstanding[worker] += 1
+                tasks = self.task_queues[worker]
+        if worker is not None:
+            tasks.put((batch_id, items))
+        elif inferred:
+            if acquired:
+                self.inflight.release()
+            print(f"Inference pool has no running workers, failing a batch of {len(inferred)} frames")
+            for handler, frame_path, sequence in sequenced:
+                self._hand_over(handler, frame_path, sequence, None)
+        # Reused frames take their turn once the results of earlier frames have been handed over
+        for handler, frame_path, sequence in reused:
+            self._hand_over(handler, frame_path, sequence, REUSE)
+
+    def _collect_results(self):
+        next_check = time.monotonic() + 1
+        while True:
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                message = False
+            if message is None:
+                break
+            if message:
+                batch_id, boxes, names, error = message
+                with self.batches_lock:
+                    entry = self.batches.pop(batch_id, None)
+                if entry is not None: # None if it was failed when its worker died
+                    self._finish_batch(entry, boxes, names, error)
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + 1
+
+    def _finish_batch(self, entry, boxes, names, error):
+        """Release a batch removed from self.batches and hand over its results (all None on error)"""
+        sequenced, slots, dispatched, worker = entry
+        with self.batches_lock:
+            self.free_slots.extend(slots)
+            self.outstanding[worker] -= 1
+            self.batches_lock.notify_all()
+        self.inflight.release()
+        INFERENCE_SECONDS.observe(time.perf_counter() - dispatched)
+        INFERENCE_BATCH_FRAMES.observe(len(sequenced))
+        if error is not None:
+            print(f"Error running inference batch of {len(sequenced)} frames: {error}")
+
+        for i, (handler, frame_path, sequence) in enumerate(sequenced):
+            result = None if error is not None else inference_pool.CompactResult(boxes[i], names)
+            self._hand_over(handler, frame_path, sequence, result)
+
+    def _check_workers(self):
+        """Fail the batches of workers that died, then restart or retire them"""
+        for i, worker in enumerate(self.workers):
+            if worker is None or worker.is_alive():
+                continue
+            with self.batches_lock:
+                if self.stopping:
+                    return
+                lost = [self.batches.pop(batch_id) for batch_id, entry in list(self.batches.items()) if entry[3] == i]
+                self.task_queues[i].cancel_join_thread() # Its batches are never read, don't wait to flush them at exit
+                if self.restarts[i] < INFERENCE_POOL_RESTARTS:
+                    self.restarts[i] += 1
+                    self._start_worker(i)
+                    action = f"restarted ({self.restarts[i]}/{INFERENCE_POOL_RESTARTS})"
+                else:
+                    self.workers[i] = None
+                    action = "retired"
+            print(f"Inference worker {i} exited with code {worker.exitcode}: {len(lost)} batches failed, worker {action}")
+            for entry in lost:
+                self._finish_batch(entry, None, None, f"inference worker {i} exited")
+
+    def _hand_over(self, handler, frame_path, sequence, result):
+        """Pass results to the handler in the order its frames were submitted (None = failed frame, REUSE = reused frame)"""
+        with self.reorder_lock:
+            expected, waiting = self.reorder.setdefault(handler.cam_num, [0, {}])
+            waiting[sequence] = (handler, frame_path, result)
+            while expected in waiting:
+                handler, frame_path, result = waiting.pop(expected)
+                expected += 1
+                handler.deliver(frame_path, result)
+            self.reorder[handler.cam_num][0] = expected
+
+class PipeFrameReader:
+    """
+    Reads raw bgr24 frames from an ffmpeg stdout pipe and hands the ones the
+    sampler keeps to a FrameHandler as numpy arrays. Frames are named with the
+    same pattern ffmpeg uses for JPEGs so labels and logs look the same in
+    both modes. Frames are timed by their place in the stream, not by when
+    they are read: ffmpeg emits frames buffered while the reader was busy back
+    to back. While the inference queue is full frames are dropped instead of
+    stalling the live stream.
+    """
+    def __init__(self, process, handler, frame_pattern, width, height, save_jpeg=False, start_index=1, sampler=None):
+        self.process = process
+        self.handler = handler
+        self.frame_pattern = frame_pattern
+        self.width = width
+        self.height = height
+        self.save_jpeg = save_jpeg
+        self.sampler = sampler # FrameSampler, or None to keep every frame
+        self.index = start_index # Number of the next kept frame, ffmpeg's image2 numbering starts at 1
+        self.captured = 0 # Frames read from the pipe
+        self.stream_start = None # Wall time of captured frame 1, captured frame n is (n - 1) / capture rate later
+        self.capture_rate = sampler.capture_rate if sampler is not None else CAPTURE_FRAME_RATE
+        self.next_pattern = None # (pattern, first index) set by rename(), applied before the next frame
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"pipe-reader-cam{handler.cam_num}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        self.thread.join()
+
+    def rename(self, frame_pattern, start_index=1):
+        """Name frames from now on with frame_pattern (a new day's directory), numbered from start_index"""
+        self.next_pattern = (frame_pattern, start_index)
+
+    def _run(self):
+        frame_size = self.width * self.height * 3
+        while not self.stopped.is_set():
+            buf = self.process.stdout.read(frame_size)
+            if len(buf) < frame_size:
+                break # ffmpeg exited, a partial trailing frame is dropped
+            self.captured += 1
+            if self.stream_start is None:
+                self.stream_start = time.time()
+            captured_at = self.stream_start + (self.captured - 1) / self.capture_rate
+            if self.sampler is not None and not self.sampler.keep(self.captured):
+                continue
+            scheduler = self.handler.scheduler
+            if scheduler is not None and scheduler.full():
+                FRAMES_TOTAL.inc(camera=self.handler.cam_num, outcome="dropped")
+                continue
+            if self.next_pattern is not None:
+                (self.frame_pattern, self.index), self.next_pattern = self.next_pattern, None
+            frame = np.frombuffer(buf, dtype=np.uint8).reshape((self.height, self.width, 3))
+            frame_path = self.frame_pattern % self.index
+            if self.save_jpeg:
+                cv2.imwrite(frame_path, frame)
+            self.handler.process_frame(frame_path, frame, captured_at)
+            self.index += 1
+        print(f"Camera {self.handler.cam_num} stream ended")
+
+class MotionGate:
+    """
+    Cheap per-camera pre-filter in front of the model. Each frame is shrunk to a
+    grayscale thumbnail and compared with the thumbnail of the last frame that
+    was sent to inference; if the mean difference stays under the threshold the
+    frame can reuse the previous detections.
+    """
+    def __init__(self, threshold=MOTION_GATE_THRESHOLD, force_interval=MOTION_GATE_FORCE_INTERVAL, size=MOTION_GATE_SIZE):
+        self.threshold = threshold
+        self.force_interval = force_interval
+        self.size = size
+        self.reference = None # Thumbnail of the last inferred frame
+        self.skipped_in_row = 0
+        self.skipped = 0
+        self.inferred = 0
+
+    def needs_inference(self, frame):
+        """Return True if the frame (BGR or grayscale) changed enough (or it's time for a forced re-inference)"""
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA).astype(np.int16)
+        if (self.reference is None
+                or self.skipped_in_row >= self.force_interval
+                or np.abs(thumbnail - self.reference).mean() > self.threshold):
+            self.reference = thumbnail
+            self.skipped_in_row = 0
+            self.inferred += 1
+            return True
+        self.skipped_in_row += 1
+        self.skipped += 1
+        return False
+
+    def reset(self):
+        """Forget the reference frame (its inference failed), so the next frame is inferred"""
+        self.reference = None
+
+    def stats(self):
+        return {'inferred': self.inferred, 'skipped': self.skipped}
+
+class FrameHandler:
+    def __init__(self, model, cam_num, logger, scheduler=None):
         self.model = model
         self.cam_num = cam_num
         self.logger = logger
-        self.processed = set()
+        self.scheduler = scheduler # Shared InferenceScheduler, or None to run inference inline
+        self.motion_gate = MotionGate() if MOTION_GATE_ENABLED else None
+        self.last_result = None # Detections of the last inferred frame, reused for unchanged frames
+        self.label_pack = None # retention.LabelPack when PACK_LABELS is set, opened with the first label
+        self.captured_at = {} # frame path -> capture time (epoch seconds) until its detections are logged
         # self.desired_classes = [1, 2, ...] # Define the classes you want to detect
         
-    def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.jpg'):
-            if event.src_path not in self.processed:
-                self.processed.add(event.src_path)
-                self.process_frame(event.src_path)
-                
-    def process_frame(self, frame_path):
+    def process_frame(self, frame_path, frame=None, captured_at=None):
+        """
+        Run detection on a frame file, or on an already decoded frame named
+        frame_path. Its detections are logged with captured_at (default: now),
+        so states.py measures movement over the time between captures.
+        """
+        self.captured_at[frame_path] = time.time() if captured_at is None else captured_at
+        if self.motion_gate is not None:
+            gate_frame = frame
+            if gate_frame is None:
+                # The gate only needs a small grayscale image: libjpeg decodes at 1/8 size, and
+                # the model reads the file itself, so no full decoded frame waits in the queue
+                gate_frame = cv2.imread(frame_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+                if gate_frame is None:
+                    print(f"Error processing {frame_path}: could not read image")
+                    FRAMES_TOTAL.inc(camera=self.cam_num, outcome="unreadable")
+                    self.captured_at.pop(frame_path, None)
+                    return
+            if not self.motion_gate.needs_inference(gate_frame):
+                if self.scheduler is not None:
+                    # Queued like any other frame: the frame it was compared with may still be in flight
+                    self.scheduler.submit(self, frame_path, REUSE)
+                else:
+                    self.deliver(frame_path, REUSE)
+                return
+
+        if self.scheduler is not None:
+            # Batched mode: the scheduler calls deliver once the batch has run
+            self.scheduler.submit(self, frame_path, frame)
+            return
+
         try:
-            results = self.model(frame_path)
+            results = self.model(frame_path if frame is None else frame)
             # if use self.desired_classes change results for
             # results = self.model(frame_path, classes=self.desired_classes)
+            result = results[0]
+        except Exception as e:
+            print(f"Error processing {frame_path}: {str(e)}")
+            result = None
+        finally:
+            memory_cleanup.frame_done()
+        self.deliver(frame_path, result)
+
+    def deliver(self, frame_path, result):
+        """
+        Called in submission order with a frame's detections, REUSE for a frame
+        the motion gate found unchanged, or None if its inference failed
+        """
+        if result is REUSE:
+            if self.last_result is None:
+                # The frame it was compared with failed, there is nothing to reuse
+                FRAMES_TOTAL.inc(camera=self.cam_num, outcome="error")
+                self.captured_at.pop(frame_path, None)
+                return
+            self.handle_result(frame_path, self.last_result, reused=True)
+        elif result is None:
+            FRAMES_TOTAL.inc(camera=self.cam_num, outcome="error")
+            self.captured_at.pop(frame_path, None)
+            self.last_result = None
+            if self.motion_gate is not None:
+                self.motion_gate.reset()
+        else:
+            self.handle_result(frame_path, result)
+
+    def handle_result(self, frame_path, result, reused=False):
+        """Write the label file, log detections and print a summary for one frame"""
+        if not reused:
+            self.last_result = result
+        FRAMES_TOTAL.inc(camera=self.cam_num, outcome="reused" if reused else "inferred")
+        captured_at = self.captured_at.pop(frame_path, None)
+        try:
             base_name = os.path.basename(frame_path)
             
-            # Create labels subdirectory if it doesn't exist
+            # Labels subdirectory next to the frames
             labels_dir = os.path.join(os.path.dirname(frame_path), "labels")
-            os.makedirs(labels_dir, exist_ok=True)
-            
-            # Save YOLO format label file in labels subdirectory
-            label_name = os.path.splitext(base_name)[0] + '.txt'
-            label_path = os.path.join(labels_dir, label_name)
-            
-            # Save labels in YOLO format (class_id, x_center, y_center, width, height)
-            with open(label_path, 'w') as f:
-                for box in results[0].boxes:
-                    cls = int(box.cls.item())
-                    xywhn = box.xywhn[0].tolist()  # Normalized coordinates
-                    f.write(f"{cls} {xywhn[0]} {xywhn[1]} {xywhn[2]} {xywhn[3]}\n")
+            start = time.perf_counter()
+            if PACK_LABELS:
+                # One line per frame in the camera's hourly label pack
+                if self.label_pack is None or self.label_pack.labels_dir != labels_dir:
+                    if self.label_pack is not None:
+                        self.label_pack.close() # Frames moved to a new day's directory
+                    self.label_pack = retention.LabelPack(labels_dir)
+                boxes = [(int(box.cls.item()), *box.xywhn[0].tolist()) for box in result.boxes]
+                label_path = self.label_pack.append(os.path.splitext(base_name)[0], boxes)
+            else:
+                os.makedirs(labels_dir, exist_ok=True)
+                
+                # Save YOLO format label file in labels subdirectory
+                label_name = os.path.splitext(base_name)[0] + '.txt'
+                label_path = os.path.join(labels_dir, label_name)
+                
+                # Save labels in YOLO format (class_id, x_center, y_center, width, height)
+                with open(label_path, 'w') as f:
+                    for box in result.boxes:
+                        cls = int(box.cls.item())
+                        xywhn = box.xywhn[0].tolist()  # Normalized coordinates
+                        f.write(f"{cls} {xywhn[0]} {xywhn[1]} {xywhn[2]} {xywhn[3]}\n")
+            LABEL_WRITE_SECONDS.observe(time.perf_counter() - start, camera=self.cam_num)
             
             # Log detections
+            start = time.perf_counter()
             self.logger.log_detection(
-                timestamp=datetime.now().isoformat(),
+                timestamp=(datetime.now() if captured_at is None else datetime.fromtimestamp(captured_at)).isoformat(timespec='microseconds'),
                 cam_num=self.cam_num,
                 filename=base_name,
-                detection=results[0]
+                detection=result
             )
+            LOG_APPEND_SECONDS.observe(time.perf_counter() - start, camera=self.cam_num)
             
             # Print detection summary
-            boxes = results[0].boxes
-            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Camera {self.cam_num} - {base_name}:")
-            print(f"Detected objects: {', '.join(results[0].names[int(box.cls.item())] for box in boxes)}")
-            print(f"Labels saved to: {label_path}")
+            if PRINT_DETECTIONS:
+                boxes = result.boxes
+                print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Camera {self.cam_num} - {base_name}:")
+                print(f"Detected objects: {', '.join(result.names[int(box.cls.item())] for box in boxes)}")
+                print(f"Labels saved to: {label_path}")
+                if reused:
+                    print("Scene unchanged - reused previous detections")
             
         except Exception as e:
             print(f"Error processing {frame_path}: {str(e)}")
-        finally:
-            # Attempt to clear GPU memory cache and Python garbage
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            gc.collect() # This collects Python objects, releasing their memory if no longer referenced      
 
-def setup_camera_system():
-    
-    print(torch.cuda.get_device_name())
-    print(torch.cuda.is_available())
-    
-    model = YOLO("/home/.../best.pt")
-    base_dir = "/home/..."
-    date_str = datetime.now().strftime("%Y%m%d")
-    
-    main_dir = f"{base_dir}/{date_str}_Animal"
-    log_dir = main_dir
-    os.makedirs(main_dir, exist_ok=True)
-    
-    logger = DetectionLogger(log_dir)
-    
-    animal_config = {
-            1: {"rtsp_url": "rtsp://...", "suffix": "#"},
-            2: {.....}
-    }
-    
-    observers = []
-    processes = []
-    
-    for cam_num, config in animal_config.items():
-        cam_dir = f"{main_dir}/cam{cam_num}"
-        os.makedirs(cam_dir, exist_ok=True)
-        
-        handler = FrameHandler(model, cam_num, logger)
-        observer = Observer()
-        observer.schedule(handler, cam_dir, recursive=False)
-        observer.start()
-        observers.append(observer)
-        
-        output_pattern = f"{cam_dir}/{datetime.now().strftime('%y%m%d')}%04d_{cam_num}_{config['suffix']}.jpg"
+def capture_pattern(cam_dir):
+    """ffmpeg image2 pattern of a camera's captured JPEGs, before FrameIngest renames the kept ones"""
+    capture_dir = os.path.join(cam_dir, INGEST_CAPTURE_DIR)
+    os.makedirs(capture_dir, exist_ok=True)
+    return os.path.join(capture_dir, "%06d.jpg")
+
+def pattern_regex(output_pattern):
+    """Regex for the file names of an ffmpeg image2 pattern (e.g. 261017%04d_1_x.jpg), frame number in group 1"""
+    name = os.path.basename(output_pattern)
+    number = re.search(r"%0?\d*d", name)
+    return re.compile(re.escape(name[:number.start()]) + r"(\d+)" + re.escape(name[number.end():]))
+
+def resume_frame_index(frame_pattern):
+    """
+    First frame number a pipe-mode camera restarted on the same day can use:
+    past the highest number among the frames and labels already saved for
+    frame_pattern, and one further so no frame pairs across the restart
+    """
+    stem_regex = pattern_regex(os.path.splitext(frame_pattern)[0])
+    frame_dir = os.path.dirname(frame_pattern)
+    labels_dir = os.path.join(frame_dir, "labels")
+    stems = []
+    for directory in (frame_dir, labels_dir):
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            stem, ext = os.path.splitext(name)
+            if ext in (".jpg", ".txt"):
+                stems.append(stem)
+            elif ext == retention.LABEL_PACK_SUFFIX:
+                try:
+                    stems.extend(retention.read_label_pack(os.path.join(directory, name)))
+                except (OSError, ValueError) as e:
+                    print(f"Error reading label pack {name}: {e}")
+    numbers = [int(match.group(1)) for match in map(stem_regex.fullmatch, stems) if match]
+    return max(numbers) + 2 if numbers else 1
+
+class FrameIngest(FileSystemEventHandler):
+    """
+    Hands one camera's JPEG frames to its FrameHandler exactly once, in order,
+    and only once they are complete. ffmpeg writes the captured frames into
+    the camera's INGEST_CAPTURE_DIR, numbered sequentially, so the number of
+    the next captured frame to take is all the state needed:
+    - a close (or rename) event takes its frame, and any earlier frames whose
+      events were lost - ffmpeg has finished those too
+    - every INGEST_SCAN_INTERVAL the files at the cursor are checked, which
+      picks up frames written while events were lost or before the observer
+      started; the newest frame is taken once the next one exists or it has
+      been unchanged for INGEST_SETTLE_SECONDS
+    Each frame the sampler keeps is moved to frame_pattern with the next
+    consecutive number, the others are deleted. Both numbers are saved in the
+    capture directory after every advance, so a restart resumes exactly after
+    the last frame taken; the kept numbering then skips one so frames from
+    either side of the gap are never paired.
+    """
+    def __init__(self, handler, capture_pattern, frame_pattern, sampler=None, scan_interval=INGEST_SCAN_INTERVAL):
+        self.handler = handler
+        self.sampler = sampler # FrameSampler, or None to keep every frame
+        self.scan_interval = scan_interval
+        self.lock = threading.Lock() # Events arrive on the observer thread, scans run on our own
+        self._follow(capture_pattern, frame_pattern)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"frame-ingest-cam{handler.cam_num}", daemon=True)
+
+    def _follow(self, capture_pattern, frame_pattern):
+        self.output_pattern = capture_pattern
+        self.frame_pattern = frame_pattern
+        self.capture_dir = os.path.dirname(capture_pattern)
+        self.name_regex = pattern_regex(capture_pattern)
+        self.cursor_path = os.path.join(self.capture_dir, INGEST_CURSOR_FILE)
+        self.next_index, self.next_frame = self._load_cursor()
+        while os.path.exists(frame_pattern % self.next_frame):
+            self.next_frame += 1 # Never overwrite a kept frame
+        self.newest_index = self.next_index - 1 # Highest captured frame number known to be on disk
+
+    def _load_cursor(self):
+        """(next captured frame number, next kept frame number)"""
+        try:
+            with open(self.cursor_path) as f:
+                saved = json.load(f)
+            if saved["pattern"] == self.output_pattern and saved["frame_pattern"] == self.frame_pattern:
+                return int(saved["next_index"]), int(saved["next_frame"]) + 1
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring frame cursor {self.cursor_path}: {e}")
+        return 1, 1
+
+    def _save_cursor(self):
+        tmp_path = self.cursor_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pattern": self.output_pattern, "next_index": self.next_index,
+                       "frame_pattern": self.frame_pattern, "next_frame": self.next_frame}, f)
+        os.replace(tmp_path, self.cursor_path)
+
+    def resume_index(self):
+        """First frame number ffmpeg can start at without overwriting a captured frame on disk"""
+        with self.lock:
+            index = self.next_index
+            while os.path.exists(self.output_pattern % index):
+                index += 1
+            return index
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        self.thread.join()
+
+    def set_output_pattern(self, capture_pattern, frame_pattern):
+        """Follow the stream to another directory (a new day) once its ffmpeg has stopped writing the old one"""
+        with self.lock:
+            self._take(settle=0) # Everything left in the old directory is complete
+            self._follow(capture_pattern, frame_pattern)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self._on_complete(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._on_complete(event.dest_path)
+
+    def _on_complete(self, path):
+        match = self.name_regex.fullmatch(os.path.basename(path))
+        if match is None or os.path.dirname(path) != self.capture_dir:
+            return
+        index = int(match.group(1))
+        with self.lock:
+            self.newest_index = max(self.newest_index, index)
+            if index < self.next_index:
+                return # Already taken (scan got there first, or duplicate event)
+            while self.next_index < index:
+                # Lost events: the frames before this one are complete
+                if self._process(self.output_pattern % self.next_index):
+                    FRAMES_RECOVERED_TOTAL.inc(camera=self.handler.cam_num)
+                else:
+                    FRAME_NUMBERS_SKIPPED_TOTAL.inc(camera=self.handler.cam_num)
+                self.next_index += 1
+            self._process(path)
+            self.next_index += 1
+            self._save_cursor()
+            self._report_lag()
+
+    def _report_lag(self):
+        INGEST_LAG_FRAMES.set(max(self.newest_index - self.next_index + 1, 0), camera=self.handler.cam_num)
+
+    def _process(self, path):
+        """Hand over the captured frame at the cursor if the sampler keeps it, False if it doesn't exist"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        INGEST_LAG_FRAMES.set(max(self.newest_index - self.next_index, 0), camera=self.handler.cam_num) # Frames after this one
+        if self.sampler is not None and not self.sampler.keep(self.next_index):
+            os.remove(path)
+            return True
+        frame_path = self.frame_pattern % self.next_frame
+        # Not os.replace: watchdog holds back every event for up to 0.5s after a file moves out of a watched directory
+        os.link(path, frame_path)
+        os.remove(path)
+        self.next_frame += 1
+        FRAME_ARRIVAL_SECONDS.observe(max(time.time() - mtime, 0.0), camera=self.handler.cam_num)
+        self.handler.process_frame(frame_path, captured_at=mtime)
+        return True
+
+    def _next_existing(self):
+        """Number of the first existing frame within INGEST_MAX_GAP after the cursor, or None"""
+        for index in range(self.next_index + 1, self.next_index + 1 + INGEST_MAX_GAP):
+            if os.path.exists(self.output_pattern % index):
+                return index
+        return None
+
+    def _take(self, settle=INGEST_SETTLE_SECONDS):
+        """Take the complete frames from the cursor on (called with the lock held)"""
+        start_index = self.next_index
+        # Frames written since the last scan, so the lag is known while a long catch-up runs
+        self.newest_index = max(self.newest_index, self.next_index - 1)
+        while os.path.exists(self.output_pattern % (self.newest_index + 1)):
+            self.newest_index += 1
+        while True:
+            path = self.output_pattern % self.next_index
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                index = self._next_existing()
+                if index is None:
+                    break
+                FRAME_NUMBERS_SKIPPED_TOTAL.inc(index - self.next_index, camera=self.handler.cam_num)
+                self.next_index = index
+                continue
+            # Complete once ffmpeg has moved on to the next frame or it stopped changing
+            if time.time() - mtime < settle and not os.path.exists(self.output_pattern % (self.next_index + 1)):
+                break
+            self._process(path)
+            FRAMES_RECOVERED_TOTAL.inc(camera=self.handler.cam_num)
+            self.next_index += 1
+        if self.next_index != start_index:
+            self._save_cursor()
+        self._report_lag()
+
+    def _run(self):
+        while not self.stopped.wait(self.scan_interval):
+            try:
+                with self.lock:
+                    self._take()
+            except Exception as e:
+                print(f"Error scanning camera {self.handler.cam_num} frames: {e}")
+
+class FrameSampler:
+    """
+    Picks the frames one camera uses out of those ffmpeg captures at
+    CAPTURE_FRAME_RATE: every stride-th captured frame, the stride following
+    the camera's current frame rate. Changing the rate never touches ffmpeg.
+    """
+    def __init__(self, frame_rate, capture_rate=CAPTURE_FRAME_RATE):
+        self.capture_rate = capture_rate
+        self.last_kept = None # Number of the last captured frame kept
+        self.set_rate(frame_rate)
+
+    def set_rate(self, frame_rate):
+        self.stride = max(1, round(self.capture_rate / frame_rate))
+        self.frame_rate = self.capture_rate / self.stride # What is actually sampled
+
+    def keep(self, index):
+        """True if captured frame number index is used (numbering that starts over is kept from its first frame)"""
+        if self.last_kept is not None and 0 < index - self.last_kept < self.stride:
+            return False
+        self.last_kept = index
+        return True
+
+class CameraStream:
+    """
+    One camera's ffmpeg process (and its PipeFrameReader in pipe mode),
+    capturing at CAPTURE_FRAME_RATE. set_frame_rate() only changes which
+    frames the sampler keeps, the stream stays connected. set_output_pattern()
+    moves the frames to another directory (a new day), numbered after any
+    frames already there.
+    """
+    def __init__(self, cam_num, rtsp_url, output_pattern, handler, frame_rate=FRAME_RATE):
+        self.cam_num = cam_num
+        self.rtsp_url = rtsp_url
+        self.output_pattern = output_pattern # Where ffmpeg writes (the capture directory in JPEG mode)
+        self.handler = handler
+        self.sampler = FrameSampler(frame_rate)
+        self.next_index = 1
+        self.process = None
+        self.reader = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def _command(self):
         cmd = [
             "ffmpeg",
             "-nostdin",
             "-rtsp_transport", "tcp",
-            "-i", config["rtsp_url"],
-            "-r", "1", # or any another interval
-            output_pattern
+            "-i", self.rtsp_url,
+            "-r", str(CAPTURE_FRAME_RATE),
         ]
-        processes.append(subprocess.Popen(cmd))
+        if CAPTURE_MODE == "pipe":
+            # Raw frames on stdout: no JPEG encode, disk round trip or watchdog event per frame
+            cmd += [
+                "-vf", f"scale={PIPE_FRAME_WIDTH}:{PIPE_FRAME_HEIGHT}",
+                "-f", "rawvideo",
+                "-pix_fmt", "bgr24",
+                "-"
+            ]
+        else:
+            cmd += ["-start_number", str(self.next_index), self.output_pattern]
+        return cmd
+
+    def start(self):
+        if CAPTURE_MODE == "pipe":
+            self.process = subprocess.Popen(self._command(), stdout=subprocess.PIPE)
+            self.reader = PipeFrameReader(self.process, self.handler, self.output_pattern, PIPE_FRAME_WIDTH, PIPE_FRAME_HEIGHT,
+                                          save_jpeg=PIPE_SAVE_JPEG, start_index=self.next_index, sampler=self.sampler)
+            self.reader.start()
+        else:
+            self.process = subprocess.Popen(self._command())
+        CAMERA_FRAME_RATE.set(self.frame_rate, camera=self.cam_num)
+
+    @property
+    def frame_rate(self):
+        return self.sampler.frame_rate
+
+    def set_frame_rate(self, frame_rate):
+        """Keep frames at frame_rate (as close as CAPTURE_FRAME_RATE allows) from the next captured frame on"""
+        old_rate = self.frame_rate
+        self.sampler.set_rate(frame_rate)
+        if self.frame_rate != old_rate:
+            print(f"Camera {self.cam_num}: {old_rate:g} -> {self.frame_rate:g} fps")
+            CAMERA_FRAME_RATE.set(self.frame_rate, camera=self.cam_num)
+
+    def set_output_pattern(self, output_pattern):
+        """Write frames with output_pattern from now on, numbered after the frames already written with it"""
+        with self.lock:
+            if self.stopped or output_pattern == self.output_pattern:
+                return
+            self.output_pattern = output_pattern
+            self.next_index = 1
+            if self.reader is not None:
+                # Pipe mode names the frames itself, the stream stays connected
+                self.next_index = resume_frame_index(output_pattern)
+                self.reader.rename(output_pattern, self.next_index)
+                return
+            # image2 only takes its pattern at startup (JPEG mode the day's capture directory)
+            self.process.terminate()
+            self.process.wait()
+            while os.path.exists(output_pattern % self.next_index):
+                self.next_index += 1 # Frames already in the directory, don't overwrite them
+            self.start()
+            CAMERA_RESTARTS_TOTAL.inc(camera=self.cam_num)
+
+    # Same shutdown interface as subprocess.Popen and the Observer/PipeFrameReader
+    def terminate(self):
+        with self.lock:
+            self.stopped = True
+            self.process.terminate()
+
+    def stop(self):
+        self.terminate()
+
+    def join(self):
+        with self.lock:
+            if self.reader is not None:
+                self.reader.join()
+
+class FrameRateController:
+    """
+    Picks each camera's frame rate from what the animal is doing on it and
+    from the inference backlog: FRAME_RATE_WALK while it walks on an active
+    camera, FRAME_RATE_REST while it rests there, FRAME_RATE_IDLE on passive
+    or empty cameras, halved while the scheduler is behind. A camera's rate
+    changes at most once per RATE_HOLD_SECONDS so it doesn't flap.
+    """
+    def __init__(self, streams, scheduler):
+        self.streams = streams # cam_num -> CameraStream
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.last_detection = {} # cam_num -> last animal detection (timestamp, camera, frame_index, x_center, y_center)
+        self.activity = {} # cam_num -> (state, monotonic time it was determined)
+        self.last_change = {} # cam_num -> monotonic time of its last rate change (or of being added)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="frame-rate-controller", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def observe(self, rows):
+        """DetectionLogger listener: track the animal state on each camera from consecutive detections"""
+        now = time.monotonic()
+        with self.lock:
+            for timestamp, cam_num, filename, object_class, x_center, y_center, *_ in rows:
+                if object_class != 'animal':
+                    continue
+                detection = {'timestamp': timestamp, 'camera': cam_num, 'frame_index': states.get_frame_index_from_filename(filename),
+                             'x_center': x_center, 'y_center': y_center}
+                previous = self.last_detection.get(cam_num)
+                self.last_detection[cam_num] = detection
+                if previous is not None and detection['frame_index'] == previous['frame_index'] + 1:
+                    state = states.determine_animal_state(previous, detection)
+                else:
+                    state = self.activity.get(cam_num, ("rest", None))[0] # Not a pair, but the animal is still here
+                self.activity[cam_num] = (state, now)
+
+    def target_rate(self, cam_num, now, throttled):
+        with self.lock:
+            state, seen_at = self.activity.get(cam_num, (None, None))
+        if cam_num in states.PASSIVE_CAMERAS or seen_at is None or now - seen_at > ACTIVITY_HOLD_SECONDS:
+            rate = FRAME_RATE_IDLE
+        elif state == "walk":
+            rate = FRAME_RATE_WALK
+        else:
+            rate = FRAME_RATE_REST
+        if throttled:
+            rate = max(rate / 2, FRAME_RATE_IDLE)
+        return rate
+
+    def _run(self):
+        while not self.stopped.wait(RATE_CHECK_INTERVAL):
+            now = time.monotonic()
+            throttled = self.scheduler is not None and self.scheduler.pending() > BACKLOG_THROTTLE_FRAMES
+            for cam_num, stream in list(self.streams.items()): # Cameras come and go with the config file
+                rate = self.target_rate(cam_num, now, throttled)
+                if rate == stream.frame_rate or now - self.last_change.setdefault(cam_num, now) < RATE_HOLD_SECONDS:
+                    continue
+                try:
+                    stream.set_frame_rate(rate)
+                    self.last_change[cam_num] = now
+                except Exception as e:
+                    print(f"Error changing frame rate of camera {cam_num}: {e}")
+
+def load_model(model_path, batch_size=INFERENCE_BATCH_SIZE):
+    """The inference model, warmed up for single frames and full batches"""
+    return model_cache.load_model(model_path, warmup_batch_sizes=sorted({1, batch_size}))
+
+def load_camera_config(path=CAMERA_CONFIG_FILE):
+    """Camera number -> {"rtsp_url", "suffix"} from the config file, or CAMERAS without one"""
+    if not os.path.exists(path):
+        return dict(CAMERAS)
+    with open(path) as f:
+        config = json.load(f)
+    cameras = {}
+    for cam_num, camera in config.items():
+        if not camera.get("rtsp_url") or "suffix" not in camera:
+            raise ValueError(f"Camera {cam_num} needs an rtsp_url and a suffix")
+        cameras[int(cam_num)] = camera
+    return cameras
+
+class Camera:
+    """One running camera: its config, FrameHandler, CameraStream and (JPEG mode) FrameIngest and watchdog Observer"""
+    def __init__(self, config, handler, stream, ingest=None, observer=None):
+        self.config = config
+        self.handler = handler
+        self.stream = stream
+        self.ingest = ingest
+        self.observer = observer
+
+class CameraSupervisor:
+    """
+    Runs the cameras for as long as the process lives. The scheduler (and model) and
+    detection logger are created once; every SUPERVISOR_CHECK_INTERVAL a
+    background check moves the logs and frames to the new day's directory
+    after midnight and applies changes to the camera config file, starting,
+    stopping or restarting only the cameras that changed.
+    """
+    def __init__(self, detection_listeners=None, config_path=CAMERA_CONFIG_FILE, base_dir=BASE_DIR):
+        self.detection_listeners = list(detection_listeners or [])
+        self.config_path = config_path
+        self.base_dir = base_dir
+        self.config_mtime = None
+        self.cameras = {} # cam_num -> Camera
+        self.streams = {} # cam_num -> CameraStream, shared with the FrameRateController
+        self.scheduler = None
+        self.controller = None
+        self.logger = None
+        self.retention_manager = None
+        self.date_str = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="camera-supervisor", daemon=True)
+
+    @property
+    def main_dir(self):
+        return f"{self.base_dir}/{self.date_str}_Animal"
+
+    def start(self):
+        self.date_str = datetime.now().strftime("%Y%m%d")
+        os.makedirs(self.main_dir, exist_ok=True)
+        
+        # One scheduler shared by every camera so their frames are batched together. The model is
+        # loaded and warmed up on its thread (or in each pool worker) while the cameras connect.
+        if INFERENCE_WORKERS:
+            self.scheduler = InferencePool(MODEL_PATH)
+        else:
+            self.scheduler = InferenceScheduler(None, model_loader=lambda: load_model(MODEL_PATH))
+        self.scheduler.start()
+        
+        self.controller = FrameRateController(self.streams, self.scheduler) if ADAPTIVE_FRAME_RATE else None
+        listeners = list(self.detection_listeners)
+        if self.controller is not None:
+            listeners.append(self.controller.observe)
+        self.logger = DetectionLogger(self.main_dir, listeners)
+        
+        self.check_config()
+        
+        if self.controller is not None:
+            self.controller.start()
+        if RETENTION_ENABLED:
+            # Background deletion of old frames
+            self.retention_manager = retention.RetentionManager(self.base_dir)
+            self.retention_manager.start()
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(SUPERVISOR_CHECK_INTERVAL):
+            try:
+                self.check_day()
+                self.check_config()
+            except Exception as e:
+                print(f"Error in camera supervisor: {e}")
+
+    def _cam_dir(self, cam_num):
+        cam_dir = f"{self.main_dir}/cam{cam_num}"
+        os.makedirs(cam_dir, exist_ok=True)
+        return cam_dir
+
+    def _output_pattern(self, cam_dir, cam_num, config):
+        return f"{cam_dir}/{self.date_str[2:]}%04d_{cam_num}_{config['suffix']}.jpg"
+
+    def start_camera(self, cam_num, config):
+        cam_dir = self._cam_dir(cam_num)
+        handler = FrameHandler(None, cam_num, self.logger, self.scheduler) # Inference always goes through the scheduler
+        output_pattern = self._output_pattern(cam_dir, cam_num, config)
+        ingest = observer = None
+        if CAPTURE_MODE == "pipe":
+            stream = CameraStream(cam_num, config["rtsp_url"], output_pattern, handler)
+            # A camera restarted during the day (config reload, restart) must not reuse its frame numbers
+            stream.next_index = resume_frame_index(output_pattern)
+        else:
+            # ffmpeg writes to the capture directory, FrameIngest moves the frames it keeps to output_pattern
+            stream = CameraStream(cam_num, config["rtsp_url"], capture_pattern(cam_dir), handler)
+            # Resume after the last frame taken before a restart; frames written but not taken yet are picked up first
+            ingest = FrameIngest(handler, stream.output_pattern, output_pattern, stream.sampler)
+            stream.next_index = ingest.resume_index()
+            observer = Observer()
+            observer.schedule(ingest, ingest.capture_dir, recursive=False)
+            observer.start()
+            ingest.start()
+        stream.start()
+        self.cameras[cam_num] = Camera(config, handler, stream, ingest, observer)
+        self.streams[cam_num] = stream
         print(f"Camera {cam_num} started - Saving to {cam_dir}")
-    
-    return observers, processes, logger
+
+    def stop_camera(self, cam_num):
+        camera = self.cameras.pop(cam_num)
+        self.streams.pop(cam_num, None)
+        camera.stream.terminate()
+        if camera.observer is not None:
+            camera.observer.stop()
+            camera.observer.join()
+        if camera.ingest is not None:
+            camera.ingest.stop() # Frames it hasn't taken yet are taken after the next start
+            camera.ingest.join()
+        camera.stream.join()
+        if camera.handler.label_pack is not None:
+            camera.handler.label_pack.close()
+        print(f"Camera {cam_num} stopped")
+
+    def check_config(self):
+        """Apply changes to the camera config file (or start CAMERAS the first time without one)"""
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if self.cameras and mtime == self.config_mtime:
+            return
+        try:
+            config = load_camera_config(self.config_path)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring camera config {self.config_path}: {e}")
+            return
+        self.config_mtime = mtime
+        for cam_num in list(self.cameras):
+            if config.get(cam_num) != self.cameras[cam_num].config:
+                self.stop_camera(cam_num)
+        for cam_num, camera_config in config.items():
+            if cam_num not in self.cameras:
+                self.start_camera(cam_num, camera_config)
+
+    def check_day(self):
+        """After midnight, move the detection log and every camera's frames to the new day's directory"""
+        date_str = datetime.now().strftime("%Y%m%d")
+        if date_str == self.date_str:
+            return
+        self.date_str = date_str
+        os.makedirs(self.main_dir, exist_ok=True)
+        self.logger.roll_over(self.main_dir)
+        for cam_num, camera in self.cameras.items():
+            cam_dir = self._cam_dir(cam_num)
+            output_pattern = self._output_pattern(cam_dir, cam_num, camera.config)
+            if camera.ingest is None:
+                camera.stream.set_output_pattern(output_pattern)
+                continue
+            camera.stream.set_output_pattern(capture_pattern(cam_dir))
+            # The old ffmpeg has exited: take its last frames, then follow the new directory
+            camera.ingest.set_output_pattern(camera.stream.output_pattern, output_pattern)
+            camera.observer.unschedule_all()
+            camera.observer.schedule(camera.ingest, camera.ingest.capture_dir, recursive=False)
+        print(f"New day: saving to {self.main_dir}")
+
+    def stop(self):
+        """Stop every camera, then write out what is still being inferred and logged"""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.controller is not None:
+            self.controller.stop()
+        for cam_num in list(self.cameras):
+            self.stop_camera(cam_num)
+        if self.retention_manager is not None:
+            self.retention_manager.stop()
+            self.retention_manager.join()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.logger is not None:
+            self.logger.close()
 
 if __name__ == "__main__":
+    supervisor = CameraSupervisor()
     try:
         print("Starting Animal Monitoring System")
         print(f"Initializing at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        metrics.start_metrics_server(METRICS_PORT)
         
-        observers, processes, logger = setup_camera_system()
+        supervisor.start()
         
         while True:
             time.sleep(1)
             
     except KeyboardInterrupt:
         print("\nShutting down...")
-        for obs in observers:
-            obs.stop()
-        for proc in processes:
-            proc.terminate()
         
     finally:
-        for obs in observers:
-            obs.join()
+        supervisor.stop()
         print("System shutdown complete")
-        print(f"Detection log saved to: {logger.log_file}")
-
+        if supervisor.logger is not None:
+            print(f"Detection log saved to: {supervisor.logger.log_file}")
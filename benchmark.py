@@ -0,0 +1,292 @@
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import animal
+import states
+
+# End-to-end benchmark without real cameras: frames are replayed into
+# CameraSupervisor-style camN/capture/ directories, picked up by FrameIngest through
+# watchdog, inferred by the shared InferenceScheduler and then run through the
+# states.py state machine, as in the live system.
+
+class StubBox:
+    """Minimal stand-in for an ultralytics box (cls and xywhn)"""
+    def __init__(self, cls, xywhn):
+        self.cls = StubTensor(cls)
+        self.xywhn = [StubTensor(xywhn)]
+
+class StubTensor:
+    def __init__(self, value):
+        self.value = value
+
+    def item(self):
+        return self.value
+
+    def tolist(self):
+        return list(self.value)
+
+class StubResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.names = {0: 'animal'}
+
+class StubModel:
+    """
+    Replaces YOLO to measure pipeline overhead alone: returns one 'animal' box
+    per frame that drifts randomly, after an optional fixed delay per batch.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.position = [0.5, 0.5]
+
+    def __call__(self, sources, **kwargs):
+        if not isinstance(sources, list):
+            sources = [sources]
+        if self.latency:
+            time.sleep(self.latency)
+        results = []
+        for _ in sources:
+            self.position = [min(max(p + random.uniform(-0.05, 0.05), 0.0), 1.0) for p in self.position]
+            results.append(StubResult([StubBox(0, [self.position[0], self.position[1], 0.1, 0.1])]))
+        return results
+
+class TimedModel:
+    """Wraps the model to record how long each (batched) call takes per frame"""
+    def __init__(self, model, stats):
+        self.model = model
+        self.stats = stats
+
+    def __call__(self, sources, **kwargs):
+        start = time.perf_counter()
+        results = self.model(sources, **kwargs)
+        elapsed = time.perf_counter() - start
+        count = len(sources) if isinstance(sources, list) else 1
+        with self.stats.lock:
+            self.stats.inference.extend([elapsed / count] * count)
+        return results
+
+class BenchStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrivals = {} # frame path -> time FrameIngest handed the complete frame over
+        self.inference = [] # model seconds per frame
+        self.frame_latency = [] # seconds from complete frame to labels/log written
+        self.state_latency = [] # seconds from frame capture (detection timestamp) to state log row
+        self.frames_written = 0
+        self.frames_done = 0
+        self.rss_samples = []
+
+class BenchFrameHandler(animal.FrameHandler):
+    """FrameHandler that timestamps each frame's arrival and completion"""
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    def process_frame(self, frame_path, frame=None, captured_at=None):
+        with self.stats.lock:
+            self.stats.arrivals.setdefault(frame_path, time.perf_counter())
+        super().process_frame(frame_path, frame, captured_at)
+
+    def handle_result(self, frame_path, result, reused=False):
+        super().handle_result(frame_path, result, reused)
+        with self.stats.lock:
+            arrived = self.stats.arrivals.pop(frame_path, None)
+            if arrived is not None:
+                self.stats.frame_latency.append(time.perf_counter() - arrived)
+            self.stats.frames_done += 1
+
+def frame_pattern(cam_dir, cam_num):
+    """Pattern FrameIngest names one benchmark camera's frames with"""
+    return f"{cam_dir}/{datetime.now().strftime('%y%m%d')}%04d_{cam_num}_bench.jpg"
+
+def replay_frames(source_frames, cam_dir, cam_num, fps, stop, stats, start_index=1):
+    """Copy frames into cam_dir's capture directory at fps with ffmpeg-style sequential names, looping over the source"""
+    output_pattern = animal.capture_pattern(cam_dir)
+    index = start_index
+    next_time = time.monotonic()
+    while not stop.is_set():
+        source = source_frames[(index - 1) % len(source_frames)]
+        shutil.copyfile(source, output_pattern % index)
+        with stats.lock:
+            stats.frames_written += 1
+        index += 1
+        next_time += 1.0 / fps
+        stop.wait(max(0.0, next_time - time.monotonic()))
+
+def start_video_replay(video, cam_dir, cam_num, fps, start_index=1):
+    """Local ffmpeg stand-in for an RTSP camera: decode a video file in real time into JPEGs"""
+    output_pattern = animal.capture_pattern(cam_dir)
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-loglevel", "error",
+        "-re",
+        "-stream_loop", "-1",
+        "-i", video,
+        "-r", str(fps),
+        "-start_number", str(start_index),
+        output_pattern
+    ]
+    return subprocess.Popen(cmd)
+
+def run_state_monitor(stop, stats):
+    """Same per-tick steps as states.monitor_animal_states, timing each logged state"""
+    original_log_state_change = states.log_state_change
+
+    def timed_log_state_change(timestamp, *args, **kwargs):
+        if kwargs.get('notes', args[-1] if len(args) == 7 else "") != 'IDLE_TIMEOUT':
+            with stats.lock:
+                stats.state_latency.append((datetime.now() - timestamp).total_seconds())
+        original_log_state_change(timestamp, *args, **kwargs)
+
+    states.log_state_change = timed_log_state_change
+    last_frame_per_camera = {}
+    try:
+        while not stop.is_set():
+            states.check_idle_timeout(datetime.now())
+            animal_detections = states.get_animal_detections()
+            if not animal_detections.empty:
+                states.process_detections(animal_detections, last_frame_per_camera)
+            stop.wait(states.CHECK_INTERVAL)
+    finally:
+        states.log_state_change = original_log_state_change
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+    return f"p50 {pick(0.50):.1f} ms, p90 {pick(0.90):.1f} ms, p99 {pick(0.99):.1f} ms, max {values[-1] * 1000:.1f} ms (n={len(values)})"
+
+def run_benchmark(args):
+    out_dir = args.output or tempfile.mkdtemp(prefix="animal_bench_")
+    os.makedirs(out_dir, exist_ok=True)
+    stats = BenchStats()
+    stop = threading.Event()
+
+    # Point states.py at the benchmark's logs
+    states.ACTIVE_CAMERAS = range(1, args.cameras + 1)
+    states.PASSIVE_CAMERAS = range(0, 0)
+    states.MAIN_DIR = out_dir
+    states.CSV_FILE = os.path.join(out_dir, 'animal_detections_log.csv')
+    states.STATE_LOG_FILE = os.path.join(out_dir, 'animal_states_log.csv')
+    states.detection_log_reader = states.DetectionLogReader(states.CSV_FILE)
+    states.detection_log_reader.skip_existing() # A reused --output keeps the earlier runs' rows
+    states.open_state_log()
+
+    if not args.verbose:
+        animal.PRINT_DETECTIONS = states.PRINT_STATES = False # Console output is measurable overhead
+
+    logger = animal.DetectionLogger(out_dir)
+    if args.workers:
+        # Workers load the model themselves; inference time is then only visible in the end-to-end latency
+        model = None
+        scheduler = animal.InferencePool(args.model, workers=args.workers, batch_size=args.batch_size, max_wait=args.max_wait)
+    else:
+        model = StubModel(args.stub_latency / 1000) if args.stub_model else animal.load_model(args.model, args.batch_size)
+        scheduler = animal.InferenceScheduler(TimedModel(model, stats), batch_size=args.batch_size, max_wait=args.max_wait)
+    scheduler.start()
+
+    source_frames = []
+    if args.frames:
+        source_frames = sorted(os.path.join(args.frames, f) for f in os.listdir(args.frames) if f.endswith('.jpg'))
+        if not source_frames:
+            sys.exit(f"No .jpg frames found in {args.frames}")
+
+    observers, workers, processes = [], [], []
+    for cam_num in range(1, args.cameras + 1):
+        cam_dir = f"{out_dir}/cam{cam_num}"
+        os.makedirs(cam_dir, exist_ok=True)
+        handler = BenchFrameHandler(model, cam_num, logger, scheduler, stats=stats)
+        ingest = animal.FrameIngest(handler, animal.capture_pattern(cam_dir), frame_pattern(cam_dir, cam_num))
+        observer = animal.Observer()
+        observer.schedule(ingest, ingest.capture_dir, recursive=False)
+        observer.start()
+        ingest.start()
+        observers.extend([observer, ingest])
+        start_index = ingest.resume_index() # A reused --output directory continues its numbering
+        if args.video:
+            processes.append(start_video_replay(args.video, cam_dir, cam_num, args.fps, start_index))
+        else:
+            workers.append(threading.Thread(target=replay_frames, args=(source_frames, cam_dir, cam_num, args.fps, stop, stats, start_index), daemon=True))
+
+    workers.append(threading.Thread(target=run_state_monitor, args=(stop, stats), daemon=True))
+
+    print(f"Benchmark: {args.cameras} cameras at {args.fps} fps for {args.duration}s "
+          f"({'stub model' if args.stub_model else args.model}"
+          f"{f', {args.workers} inference workers' if args.workers else ''}), output in {out_dir}")
+    cpu_start = os.times()
+    wall_start = time.monotonic()
+    for worker in workers:
+        worker.start()
+
+    while time.monotonic() - wall_start < args.duration:
+        time.sleep(1)
+        rss = animal.get_rss_mb()
+        if rss is not None:
+            stats.rss_samples.append(rss)
+
+    # Stop intake, then let the pipeline drain
+    stop.set()
+    for proc in processes:
+        proc.terminate()
+        proc.wait()
+    for obs in observers:
+        obs.stop()
+        obs.join()
+    scheduler.stop()
+    logger.close()
+    wall = time.monotonic() - wall_start
+    cpu_end = os.times()
+    for worker in workers:
+        worker.join()
+    states.close_state_log()
+
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    cpu_children = (cpu_end.children_user - cpu_start.children_user) + (cpu_end.children_system - cpu_start.children_system)
+    frames_in = stats.frames_written if not args.video else len(stats.frame_latency) + len(stats.arrivals)
+    print("")
+    print(f"Frames written:        {frames_in}")
+    print(f"Frames processed:      {stats.frames_done} ({stats.frames_done / wall:.2f} frames/s)")
+    print(f"Frames seen, not done: {len(stats.arrivals)} (unreadable or still queued at the end)")
+    print(f"Inference per frame:   {percentiles(stats.inference)}")
+    print(f"Frame ready -> logged: {percentiles(stats.frame_latency)}")
+    print(f"Capture -> state:      {percentiles(stats.state_latency)}")
+    print(f"CPU (this process):    {cpu:.1f} s ({100 * cpu / wall:.0f}% of one core)")
+    if args.video or args.workers:
+        print(f"CPU (child processes): {cpu_children:.1f} s (ffmpeg, inference workers)")
+    if stats.rss_samples:
+        print(f"RSS:                   avg {sum(stats.rss_samples) / len(stats.rss_samples):.0f} MB, peak {max(stats.rss_samples):.0f} MB")
+    print(f"Memory cleanups:       {animal.memory_cleanup.stats()['runs']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay frames through the detection and state pipeline and report throughput and latency")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--frames", help="directory of .jpg frames to replay (looped)")
+    source.add_argument("--video", help="video file decoded in real time by a local ffmpeg per camera")
+    parser.add_argument("--cameras", type=int, default=4, help="number of simulated cameras")
+    parser.add_argument("--fps", type=float, default=1.0, help="frames per second per camera")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to feed frames")
+    parser.add_argument("--model", default="/home/.../best.pt", help="YOLO weights")
+    parser.add_argument("--stub-model", action="store_true", help="use a stub model to measure pipeline overhead only")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="stub model delay per batch in ms")
+    parser.add_argument("--workers", type=int, default=animal.INFERENCE_WORKERS, help="inference worker processes (0 = in-process scheduler)")
+    parser.add_argument("--batch-size", type=int, default=animal.INFERENCE_BATCH_SIZE)
+    parser.add_argument("--max-wait", type=float, default=animal.INFERENCE_MAX_WAIT)
+    parser.add_argument("--output", help="directory for camera frames and logs (default: a new temp dir)")
+    parser.add_argument("--verbose", action="store_true", help="keep the per-frame console output")
+    args = parser.parse_args()
+    if args.workers and args.stub_model:
+        parser.error("--stub-model runs in this process and can't be combined with --workers")
+    run_benchmark(args)
+
+if __name__ == "__main__":
+    main()
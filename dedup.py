@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+
+class BoundedDedupSet:
+    """
+    Set used for duplicate suppression in long-running processes. Holds at
+    most max_size keys, evicting the oldest first, and optionally forgets keys
+    after max_age seconds. Memory stays flat however long the process runs.
+    """
+    def __init__(self, max_size, max_age=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.clock = clock
+        self.items = OrderedDict() # key -> time added, oldest first
+        self.evictions = 0
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, key):
+        self.items[key] = self.clock()
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+        self._expire()
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        """Current size and number of keys evicted so far"""
+        return {'size': len(self.items), 'evictions': self.evictions}
+
+    def _expire(self):
+        if self.max_age is None:
+            return
+        cutoff = self.clock() - self.max_age
+        while self.items:
+            key, added = next(iter(self.items.items()))
+            if added > cutoff:
+                break
+            del self.items[key]
+            self.evictions += 1
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+# Worker side of the multi-process CPU inference pool (animal.InferencePool).
+# Each worker process is pinned to its own share of the cores, loads the model
+# once (through model_cache, warmed up) and answers batches with compact box tuples instead of ultralytics
+# Results, which are large and slow to pickle. Only numpy and the standard
+# library are imported at module level so spawned workers start cheaply.
+
+def split_cores(workers, cores=None):
+    """Divide the usable cores into one contiguous share per worker"""
+    cores = sorted(os.sched_getaffinity(0) if cores is None else cores)
+    workers = max(1, min(workers, len(cores)))
+    share, extra = divmod(len(cores), workers)
+    shares = []
+    start = 0
+    for i in range(workers):
+        end = start + share + (1 if i < extra else 0)
+        shares.append(cores[start:end])
+        start = end
+    return shares
+
+class FrameSlot:
+    """A shared memory block holding one raw frame on its way to a worker"""
+    def __init__(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def size(self):
+        return self.shm.size
+
+    def write(self, frame):
+        """Copy a frame into the block; returns the (name, shape) a worker needs to map it"""
+        np.ndarray(frame.shape, dtype=np.uint8, buffer=self.shm.buf)[...] = frame
+        return (self.shm.name, frame.shape)
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+class CompactTensor:
+    """Just enough of a torch tensor for FrameHandler and DetectionLogger (item, tolist)"""
+    def __init__(self, value):
+        self.value = value
+
+    def item(self):
+        return self.value
+
+    def tolist(self):
+        return list(self.value)
+
+class CompactBox:
+    def __init__(self, cls, xywhn):
+        self.cls = CompactTensor(cls)
+        self.xywhn = [CompactTensor(xywhn)]
+
+class CompactResult:
+    """Stands in for an ultralytics Results object rebuilt from (cls, x, y, w, h) tuples"""
+    def __init__(self, boxes, names):
+        self.boxes = [CompactBox(box[0], box[1:]) for box in boxes]
+        self.names = names
+
+def compact_result(result):
+    """Reduce an ultralytics Results object to a list of (cls, x, y, w, h) tuples"""
+    boxes = result.boxes
+    return [(int(cls), *xywhn) for cls, xywhn in zip(boxes.cls.tolist(), boxes.xywhn.tolist())]
+
+def worker_main(model_path, cores, tasks, results, warmup_batch_sizes=(1,)):
+    """
+    Worker process loop. tasks carries (batch_id, sources) where each source
+    is a frame path or a (shared memory name, shape) pair; None stops the
+    worker. results gets (batch_id, boxes per frame, class names, error).
+    """
+    if cores:
+        os.sched_setaffinity(0, cores)
+    threads = max(1, len(cores) if cores else os.cpu_count())
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
+    import torch
+    import model_cache
+    torch.set_num_threads(threads)
+    model = model_cache.load_model(model_path, warmup_batch_sizes=warmup_batch_sizes)
+
+    attached = {} # Shared memory blocks stay mapped between batches
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_id, items = task
+        try:
+            sources = []
+            for item in items:
+                if isinstance(item, str):
+                    sources.append(item)
+                    continue
+                name, shape = item
+                if name not in attached:
+                    attached[name] = shared_memory.SharedMemory(name=name)
+                sources.append(np.ndarray(shape, dtype=np.uint8, buffer=attached[name].buf))
+            output = model(sources, batch=len(sources), verbose=False)
+            results.put((batch_id, [compact_result(result) for result in output], model.names, None))
+        except Exception as e:
+            results.put((batch_id, None, None, str(e)))
+        finally:
+            sources = output = None # Drop views into shared memory before the parent reuses the blocks
+
+    for shm in attached.values():
+        shm.close()
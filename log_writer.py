@@ -0,0 +1,122 @@
+import os
+import csv
+import time
+import queue
+import threading
+
+# Defaults for every batched writer
+FLUSH_INTERVAL = 1.0  # seconds a row may wait in memory before it is written
+FLUSH_ROWS = 256  # write as soon as this many rows are pending
+MAX_QUEUE = 10000  # queued batches before producers block (backpressure)
+FSYNC_POLICY = "interval"  # "never", "flush" (after every write) or "interval"
+FSYNC_INTERVAL = 5.0  # seconds between fsyncs with the "interval" policy
+
+class BatchedWriter:
+    """
+    Background writer for one output, shared by every producer in the
+    process. Rows go through a bounded queue to a single thread that writes
+    them in batches, flushed on a time or size threshold. Rows from different
+    threads are never interleaved. Subclasses implement _write, _fsync and
+    _close_output.
+    """
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, flush_rows=FLUSH_ROWS,
+                 max_queue=MAX_QUEUE, fsync_policy=FSYNC_POLICY, fsync_interval=FSYNC_INTERVAL):
+        if fsync_policy not in ("never", "flush", "interval"):
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=f"writer-{os.path.basename(path)}", daemon=True)
+
+    def write_row(self, row):
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        """Queue rows for writing; blocks only if the queue is full"""
+        if rows:
+            self.queue.put(rows)
+
+    def close(self):
+        """Write everything still queued, sync and close the output"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        pending = []
+        first_pending_at = None # When the oldest unwritten row arrived
+        last_fsync = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                if pending:
+                    timeout = self.flush_interval - (time.monotonic() - first_pending_at)
+                    item = self.queue.get(timeout=max(timeout, 0.001))
+                else:
+                    item = self.queue.get()
+                if item is None:
+                    stopping = True
+                else:
+                    if not pending:
+                        first_pending_at = time.monotonic()
+                    pending.extend(item)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if pending and (stopping or len(pending) >= self.flush_rows or now - first_pending_at >= self.flush_interval):
+                self._write(pending)
+                pending = []
+                if self.fsync_policy == "flush" or (self.fsync_policy == "interval" and now - last_fsync >= self.fsync_interval):
+                    self._fsync()
+                    last_fsync = now
+
+        if self.fsync_policy != "never":
+            self._fsync()
+        self._close_output()
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+    def _fsync(self):
+        raise NotImplementedError
+
+    def _close_output(self):
+        raise NotImplementedError
+
+class BatchedCsvWriter(BatchedWriter):
+    """CSV log file written by a BatchedWriter through one long-lived file handle"""
+    def __init__(self, path, header=None, **kwargs):
+        super().__init__(path, **kwargs)
+
+        # Write the header up front so readers see it before the first batch
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file and header:
+            self.writer.writerow(header)
+            self.file.flush()
+
+        self.thread.start()
+
+    def _write(self, rows):
+        try:
+            self.writer.writerows(rows)
+            self.file.flush()
+        except Exception as e:
+            print(f"Error writing to log file {self.path}: {e}")
+
+    def _fsync(self):
+        try:
+            os.fsync(self.file.fileno())
+        except Exception as e:
+            print(f"Error syncing log file {self.path}: {e}")
+
+    def _close_output(self):
+        self.file.close()
@@ -0,0 +1,114 @@
+import os
+import glob
+import time
+import fcntl
+import numpy as np
+
+# Model loading for animal.py and the inference workers. torch and ultralytics
+# are imported only here, when a model is actually loaded, so the cameras can
+# start connecting first. On CPU hosts the .pt weights are exported once to
+# MODEL_EXPORT_FORMAT next to the weights and the export is reused on every
+# later start until the weights change. Every model is warmed up with dummy
+# frames before the first real one arrives.
+MODEL_EXPORT_FORMAT = "onnx"  # CPU inference artifact: "onnx", "torchscript" or "openvino"; None runs the .pt weights
+MODEL_IMAGE_SIZE = 640  # input size the export is built for, and of the warm-up frames
+
+EXPORT_SUFFIXES = {"onnx": ".onnx", "torchscript": ".torchscript", "openvino": "_openvino_model"}
+
+_gpu = None
+
+def gpu_available():
+    """True if a CUDA device can be used; CPU hosts without /dev/nvidia* never import torch to find out"""
+    global _gpu
+    if _gpu is None:
+        if not glob.glob("/dev/nvidia[0-9]*"):
+            _gpu = False
+        else:
+            import torch
+            _gpu = torch.cuda.is_available()
+    return _gpu
+
+def exported_path(model_path, export_format):
+    """Where ultralytics writes the export of model_path"""
+    return os.path.splitext(model_path)[0] + EXPORT_SUFFIXES[export_format]
+
+def cached_export(model_path, export_format=MODEL_EXPORT_FORMAT):
+    """
+    Path of the export of model_path, exporting it first if it's missing or
+    older than the weights. A lock file keeps the inference workers from
+    exporting at the same time; the first one exports, the others reuse it.
+    Falls back to model_path if the export fails; the failure is recorded
+    next to the weights, so it isn't retried until the weights change.
+    """
+    path = exported_path(model_path, export_format)
+    failed_path = path + ".failed"
+    try:
+        lock = open(path + ".lock", "w")
+    except OSError as e:
+        print(f"Can't cache an export next to {model_path}, using it directly: {e}")
+        return model_path
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        weights_mtime = os.path.getmtime(model_path)
+        if os.path.exists(path) and os.path.getmtime(path) >= weights_mtime:
+            return path
+        try:
+            with open(failed_path) as f:
+                if float(f.readline()) == weights_mtime:
+                    print(f"Export of {model_path} to {export_format} failed before ({failed_path}), using the weights")
+                    return model_path
+        except (OSError, ValueError):
+            pass
+
+        from ultralytics import YOLO
+        print(f"Exporting {model_path} to {export_format}, reused on later starts...")
+        start = time.perf_counter()
+        export_args = {"format": export_format, "imgsz": MODEL_IMAGE_SIZE}
+        if export_format in ("onnx", "openvino"):
+            export_args["dynamic"] = True # Batches vary in size
+        try:
+            path = YOLO(model_path).export(**export_args)
+        except Exception as e:
+            print(f"Export to {export_format} failed, using {model_path}: {e}")
+            try:
+                with open(failed_path, "w") as f:
+                    f.write(f"{weights_mtime!r}\n{e}\n") # Delete to retry with the same weights
+            except OSError:
+                pass
+            return model_path
+        print(f"Exported {path} in {time.perf_counter() - start:.1f}s")
+        return str(path)
+
+def warm_up(model, batch_sizes=(1,)):
+    """Run dummy batches so the first real frame doesn't pay for lazy initialization"""
+    frame = np.zeros((MODEL_IMAGE_SIZE, MODEL_IMAGE_SIZE, 3), dtype=np.uint8)
+    for batch_size in batch_sizes:
+        model([frame] * batch_size, batch=batch_size, verbose=False)
+
+def load_model(model_path, export_format=MODEL_EXPORT_FORMAT, warmup_batch_sizes=(1,)):
+    """
+    YOLO model ready for inference: the cached export on CPU hosts, the .pt
+    weights on GPU hosts. If the export can't be loaded it is replaced by the
+    weights rather than failing the start.
+    """
+    from ultralytics import YOLO
+    start = time.perf_counter()
+    gpu = gpu_available()
+    if gpu:
+        import torch
+        print(f"Using GPU {torch.cuda.get_device_name()}")
+    path = model_path
+    if export_format and not gpu:
+        path = cached_export(model_path, export_format)
+    try:
+        model = YOLO(path, task="detect")
+        warm_up(model, warmup_batch_sizes)
+    except Exception as e:
+        if path == model_path:
+            raise
+        print(f"Could not use {path} ({e}), loading {model_path}")
+        path = model_path
+        model = YOLO(path, task="detect")
+        warm_up(model, warmup_batch_sizes)
+    print(f"Model {path} ready on {'GPU' if gpu else 'CPU'} in {time.perf_counter() - start:.1f}s")
+    return model
@@ -0,0 +1,114 @@
+import sys
+import time
+import queue
+import threading
+import pandas as pd
+from datetime import datetime
+
+import animal
+import states
+import web
+import metrics
+
+# Single-process mode: detections go straight from FrameHandler to the state machine
+# in states.py and from there to the WebSocket publisher and/or the local server.
+# The CSV logs are still written, but only as sinks - nothing polls them.
+PIPELINE_QUEUE_SIZE = 1000  # detection batches buffered before the detector is slowed down
+
+class StateStage:
+    """
+    Runs the states.py state machine on detections pushed in by the
+    DetectionLogger and publishes the confirmed state whenever it changes.
+    The bounded queue applies backpressure to inference when states fall behind.
+    """
+    def __init__(self, publishers, animal_name=web.ANIMAL_NAME, maxsize=PIPELINE_QUEUE_SIZE):
+        self.publishers = publishers # web.StatePublisher / web.StateServer
+        self.animal_name = animal_name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="state-stage", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Process what is already queued, then stop"""
+        self.stopped.set()
+        self.thread.join()
+
+    def put(self, rows):
+        # DetectionLogger listener; blocks while the queue is full
+        self.queue.put(rows)
+
+    def _drain(self, first):
+        """Combine every batch waiting in the queue into one DataFrame"""
+        rows = list(first)
+        while True:
+            try:
+                rows.extend(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return pd.DataFrame(rows, columns=animal.DETECTION_LOG_HEADER)
+
+    def _run(self):
+        last_frame_per_camera = {}  # Stores the last seen frame per camera
+        last_published_state = None
+
+        while not (self.stopped.is_set() and self.queue.empty()):
+            try:
+                rows = self.queue.get(timeout=states.CHECK_INTERVAL)
+            except queue.Empty:
+                rows = None
+
+            try:
+                # Idle timeout is still checked when no detections arrive
+                states.check_idle_timeout(datetime.now())
+
+                if rows:
+                    animal_detections = states.select_animal_detections(self._drain(rows))
+                    if not animal_detections.empty:
+                        states.process_detections(animal_detections, last_frame_per_camera)
+
+                if states.day_rollover_due():
+                    states.roll_over_day() # New day's state log; detections arrive here directly, no reader to drain
+
+                if states.last_confirmed_state != last_published_state:
+                    last_published_state = states.last_confirmed_state
+                    for publisher in self.publishers:
+                        publisher.publish({self.animal_name: last_published_state})
+                    print(f"{self.animal_name} - {last_published_state}")
+            except Exception as e:
+                print(f"Error in state stage: {e}")
+
+def run_pipeline(animal_name=web.ANIMAL_NAME):
+    print("Starting Animal Monitoring System (single-process pipeline)")
+    print(f"Initializing at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    metrics.start_metrics_server(animal.METRICS_PORT) # One endpoint serves every stage in this process
+
+    publishers = web.start_publishers()
+    state_stage = StateStage(publishers, animal_name)
+    state_stage.start()
+    states.open_state_log() # Create the state log (with header) before the first state arrives
+
+    supervisor = animal.CameraSupervisor(detection_listeners=[state_stage.put])
+    try:
+        supervisor.start()
+
+        while True:
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+
+    finally:
+        # Stop upstream first so every stage drains what it already has
+        supervisor.stop()
+        state_stage.stop()
+        states.close_state_log()
+        for publisher in publishers:
+            publisher.stop()
+        print("System shutdown complete")
+
+if __name__ == "__main__":
+    animal_name = sys.argv[1] if len(sys.argv) > 1 else web.ANIMAL_NAME
+    run_pipeline(animal_name)
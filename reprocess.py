@@ -0,0 +1,192 @@
+import os
+import re
+import ast
+import sys
+import math
+import time
+import argparse
+import itertools
+import pandas as pd
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import states
+import storage
+
+# Offline reprocessing: recompute the state log of past days from their
+# animal_detections_log.csv as fast as the CPU allows, optionally for several
+# states.py settings at once (e.g. MOVEMENT_THRESHOLD=0.01,0.02,0.05).
+# Rows go through the same states.py functions as monitor_animal_states, tick
+# by tick, with the clock driven by the detection timestamps instead of the wall clock.
+
+DETECTION_LOG_NAME = 'animal_detections_log.csv'
+STATE_LOG_NAME = 'animal_states_log.csv'
+
+def find_detection_log(path):
+    """Accept a detection log CSV or a {date}_Animal directory"""
+    if os.path.isdir(path):
+        path = os.path.join(path, DETECTION_LOG_NAME)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No detection log at {path}")
+    return path
+
+def parse_value(text):
+    """Parse one sweep value: "1-4" is a camera range (inclusive), anything else a Python literal or a string"""
+    match = re.fullmatch(r"(\d+)-(\d+)", text)
+    if match:
+        return range(int(match.group(1)), int(match.group(2)) + 1)
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+def format_value(value):
+    if isinstance(value, range):
+        return f"{value.start}-{value.stop - 1}"
+    return str(value)
+
+def parse_settings(assignments):
+    """Turn ["NAME=v1,v2", ...] into a list of {NAME: value} dicts, one per combination"""
+    names, choices = [], []
+    for assignment in assignments:
+        name, _, values = assignment.partition('=')
+        name = name.strip()
+        if not name.isupper() or not hasattr(states, name):
+            raise ValueError(f"{name} is not a states.py setting")
+        names.append(name)
+        choices.append([parse_value(value.strip()) for value in values.split(',')])
+    return [dict(zip(names, combination)) for combination in itertools.product(*choices)]
+
+def settings_label(settings):
+    return "_".join(f"{name}={format_value(value)}" for name, value in settings.items())
+
+def read_detections(path):
+    """Parse a whole detection log once; every settings combination of the day reuses the result"""
+    df = pd.read_csv(path, index_col=False, low_memory=False, on_bad_lines='skip')
+    return states.select_animal_detections(df)
+
+def fire_idle_timeouts(start, interval, until):
+    """
+    Run the idle timeout checks the live loop would have made in ticks without
+    detections, before the tick at until (None = until every track timed out).
+    """
+    timeout = timedelta(seconds=states.IDLE_TIMEOUT_SECONDS)
+    while True:
+        deadlines = [track.last_state_relevant_timestamp + timeout for track in states.track_states.values()
+                     if track.last_state_relevant_timestamp is not None and (track.last_confirmed_state != "unknown" or track.state_sequence)]
+        if not deadlines:
+            return
+        first = min(deadlines)
+        check_time = start + math.ceil((first - start) / interval) * interval
+        if check_time < first: # Rounding
+            check_time += interval
+        if until is not None and check_time >= until:
+            return
+        states.check_idle_timeout(check_time)
+
+def simulate(detections):
+    """
+    Same steps as monitor_animal_states: every CHECK_INTERVAL an idle timeout
+    check, then the rows that arrived since the previous check. Rows belong
+    to the check at the end of the interval their timestamp falls in.
+    Pair states only depend on the order of the rows, so they are computed
+    for the whole day at once; only confirmation and idle timeouts go tick by tick.
+    """
+    if detections.empty:
+        return
+    detections = detections.sort_values('timestamp', kind='stable')
+    pairs = states.compute_pair_states(detections, {})
+    if pairs.empty:
+        return
+
+    interval = timedelta(seconds=states.CHECK_INTERVAL)
+    start = detections['timestamp'].iloc[0]
+    ticks = ((pairs['timestamp'] - start) / interval).astype(int).tolist()
+    current_tick = None
+    for pair, tick in zip(pairs.itertuples(index=False), ticks):
+        if tick != current_tick:
+            # Ticks without pairs can only matter through idle timeouts
+            check_time = start + (tick + 1) * interval
+            fire_idle_timeouts(start, interval, check_time)
+            states.check_idle_timeout(check_time)
+            current_tick = tick
+        states.apply_pair_state(pair)
+    fire_idle_timeouts(start, interval, None)
+
+def run_settings(detections, settings, output_path):
+    """Recompute one state log with states.py globals overridden by settings"""
+    original = {name: getattr(states, name) for name in settings}
+    try:
+        for name, value in settings.items():
+            setattr(states, name, value)
+        states.PRINT_STATES = False
+        states.STATE_LOG_FILE = output_path
+        storage.STORAGE_BACKEND = "csv"
+        states.reset_state_machine()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        states.open_state_log()
+        try:
+            simulate(detections)
+        finally:
+            states.close_state_log()
+    finally:
+        for name, value in original.items():
+            setattr(states, name, value)
+
+def process_day(path, output_dir, combinations):
+    """Worker: parse one day's detections once and write one state log per settings combination"""
+    start = time.perf_counter()
+    detections = read_detections(path)
+    outputs = []
+    for settings in combinations:
+        name = STATE_LOG_NAME if not settings else f"animal_states_log_{settings_label(settings)}.csv"
+        output_path = os.path.join(output_dir, name)
+        run_settings(detections, settings, output_path)
+        outputs.append(output_path)
+    return path, len(detections), outputs, time.perf_counter() - start
+
+def day_output_dir(path, output):
+    """Per day output directory: <output>/<day directory name>, or reprocessed/ next to the input"""
+    day_dir = os.path.dirname(os.path.abspath(path))
+    if output is None:
+        return os.path.join(day_dir, 'reprocessed')
+    return os.path.join(output, os.path.basename(day_dir))
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute state logs from recorded detection logs, in parallel across days")
+    parser.add_argument("inputs", nargs="+", help="animal_detections_log.csv files or {date}_Animal directories")
+    parser.add_argument("--set", dest="settings", action="append", default=[], metavar="NAME=V1,V2",
+                        help="override a states.py setting; several values sweep it (camera ranges as 1-4)")
+    parser.add_argument("--output", help="output root (default: reprocessed/ inside each day directory)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+
+    try:
+        combinations = parse_settings(args.settings) or [{}]
+        paths = [find_detection_log(path) for path in args.inputs]
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+
+    print(f"Reprocessing {len(paths)} day(s) x {len(combinations)} setting combination(s) with {args.jobs} workers")
+    wall_start = time.perf_counter()
+    failed = False
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for path in paths:
+            output_dir = day_output_dir(path, args.output)
+            os.makedirs(output_dir, exist_ok=True)
+            futures[executor.submit(process_day, path, output_dir, combinations)] = path
+        for future in as_completed(futures):
+            try:
+                path, rows, outputs, seconds = future.result()
+            except Exception as e:
+                print(f"Error reprocessing {futures[future]}: {e}")
+                failed = True
+                continue
+            print(f"{path}: {rows} animal detections in {seconds:.1f}s -> {', '.join(outputs)}")
+    print(f"Done in {time.perf_counter() - wall_start:.1f}s")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import os
+import glob
+import time
+import threading
+from datetime import datetime
+
+import metrics
+
+# Retention for captured frames and their labels. Every camera directory of
+# every {date}_Animal day gets a size and an age budget; the oldest frames are
+# deleted first. Frames with detections (a non-empty label) can be kept longer.
+RETENTION_MAX_AGE_HOURS = 72  # frames without detections are deleted after this
+RETENTION_DETECTION_MAX_AGE_HOURS = 24 * 14  # frames with detections are deleted after this
+RETENTION_MAX_BYTES_PER_CAMERA = 20 * 2**30  # size budget per camera (frames + labels, all days)
+RETENTION_MIN_AGE_SECONDS = 300  # never delete anything younger, even over the size budget (frames still being processed)
+RETENTION_SCAN_INTERVAL = 300  # seconds between retention passes
+RETENTION_DELETE_PAUSE_EVERY = 500  # deletions between short pauses so a large pass doesn't monopolize the disk
+LABEL_PACK_SUFFIX = ".labels"
+
+BYTES_RETAINED = metrics.Gauge("retention_bytes", "Bytes of frames and labels kept per camera", ["camera"])
+FILES_DELETED_TOTAL = metrics.Counter("retention_files_deleted_total", "Frames (and labels without a frame) deleted by the retention manager", ["camera", "reason"])
+PASS_SECONDS = metrics.Histogram("retention_pass_seconds", "Duration of one retention pass over every camera")
+
+class LabelPack:
+    """
+    Packs one camera's labels into one append-only file per hour
+    (labels/YYYYmmdd_HH.labels) instead of a .txt per frame. Each frame is
+    one line: the frame name followed by "cls x y w h" groups separated by ';'
+    (just the name when nothing was detected).
+    """
+    def __init__(self, labels_dir):
+        self.labels_dir = labels_dir
+        self.hour = None
+        self.file = None
+        self.lock = threading.Lock() # Reused-result frames are written from the capture thread, the rest from the scheduler
+
+    def path_for(self, hour):
+        return os.path.join(self.labels_dir, f"{hour}{LABEL_PACK_SUFFIX}")
+
+    def append(self, frame_name, boxes):
+        """boxes: (cls, x, y, w, h) tuples of one frame"""
+        hour = datetime.now().strftime("%Y%m%d_%H")
+        line = frame_name + "".join(f"{';' if i else ' '}{cls} {x} {y} {w} {h}" for i, (cls, x, y, w, h) in enumerate(boxes))
+        with self.lock:
+            if hour != self.hour:
+                self._close()
+                os.makedirs(self.labels_dir, exist_ok=True)
+                self.file = open(self.path_for(hour), 'a')
+                self.hour = hour
+            self.file.write(line + "\n")
+            self.file.flush()
+            return self.file.name
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.hour = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+def read_label_pack(path):
+    """Frame names in a label pack mapped to their boxes as (cls, x, y, w, h) tuples"""
+    frames = {}
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break # Still being written
+            name, _, rest = line.rstrip("\n").partition(" ")
+            boxes = []
+            for group in rest.split(";") if rest else []:
+                cls, x, y, w, h = group.split()
+                boxes.append((int(cls), float(x), float(y), float(w), float(h)))
+            frames[name] = boxes
+    return frames
+
+class RetentionManager:
+    """
+    Background thread that keeps every camera's frames within their budgets.
+    Each pass scans the camN/ directories of all days under base_dir, deletes
+    frames past their age (longer for frames with detections), then the
+    oldest frames until the camera fits its size budget, frames without
+    detections going first. A frame's label file goes with it; labels without a
+    frame are aged and counted the same way.
+    """
+    def __init__(self, base_dir, max_age_hours=RETENTION_MAX_AGE_HOURS,
+                 detection_max_age_hours=RETENTION_DETECTION_MAX_AGE_HOURS,
+                 max_bytes_per_camera=RETENTION_MAX_BYTES_PER_CAMERA, scan_interval=RETENTION_SCAN_INTERVAL):
+        self.base_dir = base_dir
+        self.max_age = max_age_hours * 3600
+        self.detection_max_age = detection_max_age_hours * 3600
+        self.max_bytes = max_bytes_per_camera
+        self.scan_interval = scan_interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self.deleted = 0
+        self.pack_cache = {} # label pack path -> (mtime, size, {frame name: has detections})
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_pass()
+            except Exception as e:
+                print(f"Error in retention pass: {e}")
+            self.stopped.wait(self.scan_interval)
+
+    def camera_dirs(self):
+        """camN directories of every day, grouped by camera name"""
+        cameras = {}
+        for cam_dir in sorted(glob.glob(os.path.join(self.base_dir, "*_Animal", "cam*"))):
+            if os.path.isdir(cam_dir):
+                cameras.setdefault(os.path.basename(cam_dir), []).append(cam_dir)
+        return cameras
+
+    def run_pass(self):
+        start = time.perf_counter()
+        for camera, cam_dirs in self.camera_dirs().items():
+            if self.stopped.is_set():
+                break
+            self.enforce(camera, cam_dirs, time.time())
+        PASS_SECONDS.observe(time.perf_counter() - start)
+
+    def _read_pack(self, entry):
+        """Which frames of a label pack have detections; finished (older hour) packs are parsed only once"""
+        stat = entry.stat()
+        cached = self.pack_cache.get(entry.path)
+        if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+        frames = {name: bool(boxes) for name, boxes in read_label_pack(entry.path).items()}
+        self.pack_cache[entry.path] = (stat.st_mtime, stat.st_size, frames)
+        return frames
+
+    def scan(self, cam_dir):
+        """
+        Frames of one camera directory as [mtime, bytes, frame path, label path or None, has detections],
+        and its label packs as [mtime, bytes, path, None, True]. Labels without a frame (pipe mode
+        without PIPE_SAVE_JPEG) are listed with the frames as [mtime, bytes, None, label path, has detections].
+        """
+        labels_dir = os.path.join(cam_dir, "labels")
+        label_files = {}
+        packed = {}
+        packs = []
+        if os.path.isdir(labels_dir):
+            with os.scandir(labels_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".txt"):
+                        stat = entry.stat()
+                        label_files[entry.name[:-4]] = (entry.path, stat.st_size, stat.st_mtime)
+                    elif entry.name.endswith(LABEL_PACK_SUFFIX):
+                        try:
+                            packed.update(self._read_pack(entry))
+                            stat = entry.stat()
+                            packs.append([stat.st_mtime, stat.st_size, entry.path, None, True])
+                        except (OSError, ValueError) as e:
+                            print(f"Error reading label pack {entry.path}: {e}")
+
+        frames = []
+        with os.scandir(cam_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".jpg") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                name = entry.name[:-4]
+                label_path, label_size, _ = label_files.pop(name, (None, 0, None))
+                has_detections = label_size > 0 or packed.get(name, False)
+                frames.append([stat.st_mtime, stat.st_size + label_size, entry.path, label_path, has_detections])
+        for label_path, label_size, label_mtime in label_files.values():
+            frames.append([label_mtime, label_size, None, label_path, label_size > 0])
+        return frames, packs
+
+    def enforce(self, camera, cam_dirs, now):
+        frames = []
+        total = 0
+        for cam_dir in cam_dirs:
+            cam_frames, packs = self.scan(cam_dir)
+            frames.extend(cam_frames)
+            for pack in packs:
+                # A pack can go once even its frames with detections are past their age
+                if now - pack[0] > self.detection_max_age:
+                    self._remove(pack[2])
+                    self.pack_cache.pop(pack[2], None)
+                else:
+                    total += pack[1]
+        frames.sort(key=lambda frame: frame[0]) # Oldest first
+
+        keep = []
+        for frame in frames:
+            age = now - frame[0]
+            if age > (self.detection_max_age if frame[4] else self.max_age):
+                self._delete(camera, frame, "age")
+            else:
+                keep.append(frame)
+
+        total += sum(frame[1] for frame in keep)
+        if total > self.max_bytes:
+            # Oldest frames without detections go first, then the oldest with detections
+            for frame in [f for f in keep if not f[4]] + [f for f in keep if f[4]]:
+                if total <= self.max_bytes:
+                    break
+                if now - frame[0] < RETENTION_MIN_AGE_SECONDS:
+                    continue
+                self._delete(camera, frame, "size")
+                total -= frame[1]
+        BYTES_RETAINED.set(total, camera=camera)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting {path}: {e}")
+
+    def _delete(self, camera, frame, reason):
+        _, _, frame_path, label_path, _ = frame
+        if frame_path is not None:
+            self._remove(frame_path)
+        if label_path is not None:
+            self._remove(label_path)
+        FILES_DELETED_TOTAL.inc(camera=camera, reason=reason)
+        self.deleted += 1
+        if self.deleted % RETENTION_DELETE_PAUSE_EVERY == 0:
+            time.sleep(0.05)
@@ -1,8 +1,14 @@
 import pandas as pd
+import numpy as np
+import io
 import time
 from datetime import datetime
 import os
 from collections import deque
+from log_writer import BatchedCsvWriter
+from dedup import BoundedDedupSet
+import storage
+import metrics
 
 # Base directory for the project
 BASE_DIR = "/home/..."
@@ -15,58 +21,333 @@ MAIN_DIR = f"{BASE_DIR}/{DATE_STR}_Animal"
 CSV_FILE = os.path.join(MAIN_DIR, 'animal_detections_log.csv') # Path to detection log
 PASSIVE_CAMERAS = range(0, 0)  # 0-0 inclusive
 ACTIVE_CAMERAS = range(0, 0)  # 0-0 inclusive
-MOVEMENT_THRESHOLD = 0.00
+MOVEMENT_THRESHOLD = 0.00 # Movement per second between the two frames of a pair (normalized units) above which the animal walks
 CHECK_INTERVAL = 1  # seconds between checks or another interval
 STATE_LOG_FILE = os.path.join(MAIN_DIR, 'animal_states_log.csv') # Path to state log
 CONFIRMATION_SEQUENCE_LENGTH = 1 # Number of consecutive states needed to confirm global state
 IDLE_TIMEOUT_SECONDS = 1 # Set state to unknown if no new state-relevant data for this duration
+PAIR_DEDUP_WINDOW = 10000 # Most recent pair+state combinations remembered for duplicate suppression (per track)
+TRACKING_ENABLED = False # Split detections into per-camera tracks, one state machine each; False keeps one global track
+TRACK_MAX_DISTANCE = 0.1 # Max centroid move between sequential frames (normalized, per axis) to continue a track
+TRACK_SIZE_TOLERANCE = 0.5 # Max relative change of box width and height to continue a track
+TRACK_MAX_MISSED_FRAMES = 5 # Frames a track survives without a matching detection
+GLOBAL_TRACK = 0 # Track id of every detection when tracking is off
+METRICS_PORT = 9109 # Local Prometheus endpoint (/metrics) for the monitor process, None to disable
+PRINT_STATES = True # Print every logged state to the console
+DAY_ROLLOVER_DELAY = 10 # Seconds after midnight before switching to the new day's logs, so the old day's last detections are read first
+
+# Per-stage metrics
+TICK_SECONDS = metrics.Histogram("states_tick_seconds", "Duration of one monitor check (idle timeout, read, pair processing)")
+ROWS_READ_TOTAL = metrics.Counter("states_rows_read_total", "Detection log rows read")
+ROWS_PER_TICK = metrics.Histogram("states_rows_per_tick", "Detection log rows read per check", buckets=metrics.COUNT_BUCKETS)
+STATE_LOG_APPEND_SECONDS = metrics.Histogram("states_log_append_seconds", "Time to hand one state row to the log writers")
+STATES_LOGGED_TOTAL = metrics.Counter("states_logged_total", "State log rows by determined state", ["state"])
 
 # Ensure the MAIN_DIR exists before trying to create files within it
 os.makedirs(MAIN_DIR, exist_ok=True)
 
-# Initialize state log - Ensure 'notes' column is present
-if not os.path.exists(STATE_LOG_FILE):
-    with open(STATE_LOG_FILE, 'w') as f:
-        f.write('timestamp,state,last_confirmed_state,camera,x_center,y_center,frames_used,notes\n')
+# State log columns - Ensure 'notes' column is present
+STATE_LOG_HEADER = ['timestamp', 'state', 'last_confirmed_state', 'camera', 'x_center', 'y_center', 'frames_used', 'notes', 'track', 'track_confirmed_state']
+
+class TrackState:
+    """Confirmation sequence, pair dedup and idle timer of one track (GLOBAL_TRACK covers every detection when tracking is off)"""
+    def __init__(self, track_id):
+        self.track_id = track_id
+        self.last_confirmed_state = "unknown"
+        self.state_sequence = deque(maxlen=CONFIRMATION_SEQUENCE_LENGTH) # Tracks the last N states from valid *unique pair+state* combinations
+        self.processed_pairs = BoundedDedupSet(PAIR_DEDUP_WINDOW) # Tracks (start_frame_index, end_frame_index, state) of combinations added to state_sequence
+        self.last_state_relevant_timestamp = None # Timestamp of the last state-relevant detection
 
 # Global variables
-last_confirmed_state = "unknown"
-global_state_sequence = deque(maxlen=CONFIRMATION_SEQUENCE_LENGTH) # Tracks the last N states from valid *unique pair+state* combinations
-processed_pair_state_combinations = set() # Tracks (start_frame_index, end_frame_index, state) of combinations added to global_state_sequence
+last_confirmed_state = "unknown" # Global state: the confirmed state of the most recently active track
+track_states = {} # track id -> TrackState
+
+def get_track_state(track_id):
+    track = track_states.get(track_id)
+    if track is None:
+        track = track_states[track_id] = TrackState(track_id)
+    return track
+
+def reset_state_machine():
+    """Forget every track and the confirmed state, e.g. before reprocessing another day"""
+    global last_confirmed_state, tracker
+    last_confirmed_state = "unknown"
+    track_states.clear()
+    tracker = Tracker()
+
+def refresh_last_confirmed_state(track=None):
+    """
+    Set the global state from the track with the most recent state-relevant
+    data. Pairs are applied in time order, so after a pair that is the track
+    it was applied to; only an idle timeout needs the scan over all tracks.
+    """
+    global last_confirmed_state
+    if track is not None:
+        last_confirmed_state = track.last_confirmed_state
+        return
+    active = [track for track in track_states.values() if track.last_state_relevant_timestamp is not None]
+    if not active:
+        last_confirmed_state = "unknown"
+        return
+    last_confirmed_state = max(active, key=lambda track: track.last_state_relevant_timestamp).last_confirmed_state
+
+class Track:
+    def __init__(self, track_id, frame_index, x, y, width, height):
+        self.track_id = track_id
+        self.update(frame_index, x, y, width, height)
+
+    def update(self, frame_index, x, y, width, height):
+        self.frame_index = frame_index
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def similar_size(self, width, height):
+        # Boxes without a size (detection logs from before width/height were logged) always match
+        for old, new in ((self.width, width), (self.height, height)):
+            if old == old and new == new and abs(new - old) > TRACK_SIZE_TOLERANCE * max(old, new):
+                return False
+        return True
+
+class Tracker:
+    """
+    Associates animal detections across sequential frames into track ids, per
+    camera. Each frame's detections are matched greedily to the nearest track
+    centroid, gated by TRACK_MAX_DISTANCE and box size. Tracks are bucketed in
+    a grid with cells of TRACK_MAX_DISTANCE so every detection only looks at
+    tracks in its own and the 8 neighbouring cells instead of all of them.
+    """
+    def __init__(self):
+        self.tracks = {} # camera -> list of live Tracks
+        self.next_track_id = GLOBAL_TRACK + 1
+
+    def _cell(self, x, y):
+        return (int(x // TRACK_MAX_DISTANCE), int(y // TRACK_MAX_DISTANCE))
+
+    def assign_frame(self, camera, frame_index, boxes):
+        """Return a track id for each (x, y, width, height) box detected in one frame"""
+        # A track takes at most one box per frame; tracks from a later frame (numbering restarted) are dropped
+        live = [track for track in self.tracks.get(camera, []) if 0 <= frame_index - track.frame_index <= TRACK_MAX_MISSED_FRAMES]
+        grid = {}
+        for track in live:
+            if track.frame_index < frame_index:
+                grid.setdefault(self._cell(track.x, track.y), []).append(track)
+
+        candidates = []
+        for i, (x, y, width, height) in enumerate(boxes):
+            cell_x, cell_y = self._cell(x, y)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for track in grid.get((cell_x + dx, cell_y + dy), ()):
+                        if abs(track.x - x) > TRACK_MAX_DISTANCE or abs(track.y - y) > TRACK_MAX_DISTANCE:
+                            continue
+                        if track.similar_size(width, height):
+                            # Same movement metric as calculate_movement
+                            candidates.append(((abs(track.x - x) + abs(track.y - y)) / 2, i, track))
+
+        track_ids = [None] * len(boxes)
+        taken = set()
+        for _, i, track in sorted(candidates, key=lambda candidate: candidate[0]):
+            if track_ids[i] is None and track.track_id not in taken:
+                track_ids[i] = track.track_id
+                taken.add(track.track_id)
+                track.update(frame_index, *boxes[i])
+        for i, box in enumerate(boxes):
+            if track_ids[i] is None:
+                track = Track(self.next_track_id, frame_index, *box)
+                self.next_track_id += 1
+                live.append(track)
+                track_ids[i] = track.track_id
+
+        self.tracks[camera] = live
+        return track_ids
+
+    def assign(self, frames):
+        """Track ids for a DataFrame of detections with camera, frame_index, x/y_center, width and height"""
+        cameras = frames['camera'].to_numpy()
+        frame_indexes = frames['frame_index'].to_numpy()
+        boxes = frames[['x_center', 'y_center', 'width', 'height']].to_numpy(dtype=float)
+        track_ids = np.empty(len(frames), dtype=np.int64)
+
+        # Visit each camera's frames in frame order, one frame's detections at a time
+        order = np.lexsort((frame_indexes, cameras))
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end == len(order) or cameras[order[end]] != cameras[order[start]] or frame_indexes[order[end]] != frame_indexes[order[start]]:
+                rows = order[start:end]
+                track_ids[rows] = self.assign_frame(cameras[rows[0]], frame_indexes[rows[0]], [tuple(box) for box in boxes[rows]])
+                start = end
+        return track_ids
+
+    def drop(self, track_id):
+        """Forget a track, so a detection near where it was starts a new one"""
+        for camera, tracks in self.tracks.items():
+            self.tracks[camera] = [track for track in tracks if track.track_id != track_id]
+
+    def live_track_ids(self):
+        return {track.track_id for tracks in self.tracks.values() for track in tracks}
+
+tracker = Tracker()
+
+# Background writers for the state log (CSV and/or SQLite store, see storage.STORAGE_BACKEND), opened on first use
+state_log_writer = None
+state_store_writer = None
+
+def get_state_log_writer():
+    """Return the shared state log writer, creating the file and header if needed"""
+    global state_log_writer
+    if state_log_writer is None:
+        state_log_writer = BatchedCsvWriter(STATE_LOG_FILE, header=STATE_LOG_HEADER)
+    return state_log_writer
+
+def get_state_store_writer():
+    """Return the shared writer for the states table of today's SQLite store"""
+    global state_store_writer
+    if state_store_writer is None:
+        state_store_writer = storage.SqliteBatchWriter(storage.store_path(MAIN_DIR), 'states')
+    return state_store_writer
+
+def open_state_log():
+    """Create the configured state log outputs before the first state arrives"""
+    if storage.STORAGE_BACKEND in ("csv", "both"):
+        get_state_log_writer()
+    if storage.STORAGE_BACKEND in ("sqlite", "both"):
+        get_state_store_writer()
+
+def close_state_log():
+    """Write out any queued state rows and close the state log"""
+    global state_log_writer, state_store_writer
+    if state_log_writer is not None:
+        state_log_writer.close()
+        state_log_writer = None
+    if state_store_writer is not None:
+        state_store_writer.close()
+        state_store_writer = None
+
+class DetectionLogReader:
+    """
+    Incremental reader for the detection log. Remembers the byte offset after
+    the last complete line so each call only parses rows appended since the
+    previous one. A partial trailing line is left for the next call, and a
+    truncated or rotated file is re-read from the start.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.inode = None
+        self.header = None
+
+    def reset(self):
+        self.offset = 0
+        self.header = None
+
+    def skip_existing(self):
+        """Start after the rows already in the log, so only rows appended from now on are read"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+                self.inode = os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            return
+        header_end = data.find(b'\n')
+        if header_end == -1:
+            return # No complete header yet, it is read with the first rows
+        self.header = data[:header_end].decode().strip().split(',')
+        self.offset = data.rfind(b'\n') + 1 # A partial trailing line is read once it's complete
+
+    def read_new_rows(self):
+        """Return a DataFrame of complete rows appended since the last call"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return pd.DataFrame()
+
+        # Rotated (new inode) or truncated (shorter than what we've read) -> start over
+        if self.inode is not None and (stat.st_ino != self.inode or stat.st_size < self.offset):
+            self.reset()
+        self.inode = stat.st_ino
+
+        if stat.st_size == self.offset:
+            return pd.DataFrame()
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        # Only consume up to the last newline, the rest may still be mid-write
+        end = data.rfind(b'\n')
+        if end == -1:
+            return pd.DataFrame()
+        chunk = data[:end + 1]
+        self.offset += end + 1
+
+        if self.header is None:
+            header_end = chunk.index(b'\n')
+            self.header = chunk[:header_end].decode().strip().split(',')
+            chunk = chunk[header_end + 1:]
+            if not chunk:
+                return pd.DataFrame()
+
+        # index_col=False: rows with more fields than the header (a log started before columns were added) are cut, not shifted
+        return pd.read_csv(io.BytesIO(chunk), names=self.header, header=None, index_col=False, low_memory=False, on_bad_lines='skip')
+
+detection_log_reader = DetectionLogReader(CSV_FILE)
+
+def day_rollover_due(now=None):
+    """True once the date changed and DAY_ROLLOVER_DELAY has passed since midnight"""
+    now = now or datetime.now()
+    if now.strftime("%Y%m%d") == DATE_STR:
+        return False
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (now - midnight).total_seconds() >= DAY_ROLLOVER_DELAY
+
+def roll_over_day(now=None):
+    """
+    Point the detection log reader and the state log at today's directory.
+    The state machine carries over: an animal resting at midnight is still resting.
+    """
+    global DATE_STR, MAIN_DIR, CSV_FILE, STATE_LOG_FILE, detection_log_reader
+    close_state_log()
+    DATE_STR = (now or datetime.now()).strftime("%Y%m%d")
+    MAIN_DIR = f"{BASE_DIR}/{DATE_STR}_Animal"
+    os.makedirs(MAIN_DIR, exist_ok=True)
+    CSV_FILE = os.path.join(MAIN_DIR, 'animal_detections_log.csv')
+    STATE_LOG_FILE = os.path.join(MAIN_DIR, 'animal_states_log.csv')
+    detection_log_reader = DetectionLogReader(CSV_FILE)
+    open_state_log()
+    print(f"New day: reading {CSV_FILE}, logging to {STATE_LOG_FILE}")
+
+def select_animal_detections(df):
+    """Keep only animal detections from detection log rows, with parsed timestamps"""
+    if df.empty:
+        return pd.DataFrame()
+    
+    # Filter for animal detections first
+    animals = df[df['object_class'] == 'animal'].copy()
+    
+    if animals.empty:
+        return pd.DataFrame() # Return empty if no animals found
+
+    animals['timestamp'] = pd.to_datetime(animals['timestamp'])
 
-# New global variable to track the timestamp of the last state-relevant detection
-last_state_relevant_timestamp = None
+    # Logs written before box sizes were logged have no width/height; tracking then gates on distance only
+    for column in ('width', 'height'):
+        if column not in animals:
+            animals[column] = np.nan
 
-# last_processed_timestamp (for file reading progress) is tracked locally in monitor_cat_states
+    return animals[['timestamp', 'camera', 'filename', 'x_center', 'y_center', 'width', 'height']]
 
-def get_animal_detections(last_processed_ts):
+def get_animal_detections():
     """
-    Read the CSV file and return only cat detections with required columns
-    strictly after the last processed timestamp.
+    Return animal detections with required columns from rows appended to
+    the CSV file since the previous call.
     """
     try:
-        # Use low_memory=False to avoid DtypeWarning with mixed types if any
-        df = pd.read_csv(CSV_FILE, low_memory=False)
-        
-        # Filter for animal detections first
-        animals = df[df['object_class'] == 'animal'].copy()
-        
-        if animals.empty:
-            return pd.DataFrame() # Return empty if no animals found
-
-        animals['timestamp'] = pd.to_datetime(cats['timestamp'])
-        
-        # Filter by timestamp after getting animals and parsing timestamps
-        if last_processed_ts:
-            new_animals = animals[animals['timestamp'] > last_processed_ts]
-        else:
-            new_animals = animals # Process all if starting or resuming
-
-        return new_animals[['timestamp', 'camera', 'filename', 'x_center', 'y_center']]
-
-    except FileNotFoundError:
-        # print(f"CSV file not found: {CSV_FILE}") # Avoid excessive printing if file not there yet
-        return pd.DataFrame()
+        rows = detection_log_reader.read_new_rows()
+        ROWS_READ_TOTAL.inc(len(rows))
+        ROWS_PER_TICK.observe(len(rows))
+        return select_animal_detections(rows)
     except pd.errors.EmptyDataError:
         # print(f"CSV file is empty: {CSV_FILE}") # Handle empty file case
         return pd.DataFrame()
@@ -82,6 +363,16 @@ def calculate_movement(frame1, frame2):
     # Using average of dx and dy as movement metric
     return (dx + dy) / 2
 
+def pair_seconds(timestamp1, timestamp2):
+    """
+    Time between the captures of two sequential frames, which depends on the
+    camera's current frame rate (at least 1 ms, so rows logged with the same
+    timestamp don't divide by zero). Works on scalars and Series.
+    """
+    seconds = (pd.to_datetime(timestamp2) - pd.to_datetime(timestamp1))
+    seconds = seconds.dt.total_seconds() if isinstance(seconds, pd.Series) else seconds.total_seconds()
+    return np.maximum(seconds, 0.001)
+
 def determine_animal_state(frame1, frame2):
     """Determine the animal's state from two sequential frames"""
     camera = frame1['camera']
@@ -90,9 +381,9 @@ def determine_animal_state(frame1, frame2):
     if camera in PASSIVE_CAMERAS:
         return "PASSIVE"
 
-    # Active cameras: check movement
+    # Active cameras: check movement per second, the same at any frame rate
     if camera in ACTIVE_CAMERAS:
-        movement = calculate_movement(frame1, frame2)
+        movement = calculate_movement(frame1, frame2) / pair_seconds(frame1['timestamp'], frame2['timestamp'])
         return "walk" if movement > MOVEMENT_THRESHOLD else "rest"
 
     return "unknown" # Should not happen if all cameras are in either list, but good fallback
@@ -108,55 +399,70 @@ def get_frame_index_from_filename(filename):
         # print(f"Warning: Could not extract frame index from filename: {filename}") # Avoid excessive logging
         return -1 # Indicate invalid index
 
-def add_state_to_confirmation_sequence(state):
+def add_state_to_confirmation_sequence(state, track):
     """
-    Add the determined state to the global sequence and check for global state confirmation.
+    Add the determined state to the track's sequence and check for state confirmation.
     Assumes duplicate pair+state checks have already passed.
-    Returns True if global state was just confirmed/changed.
+    Returns True if the track's state was just confirmed/changed.
     """
-    global last_confirmed_state, global_state_sequence
+    sequence = track.state_sequence
+    sequence.append(state)
 
-    global_state_sequence.append(state)
-
-    # Check for global state confirmation
-    if len(global_state_sequence) == CONFIRMATION_SEQUENCE_LENGTH and all(s == global_state_sequence[0] for s in global_state_sequence):
-        if last_confirmed_state != global_state_sequence[0]: # Compare against the consistent state in the deque
-            last_confirmed_state = global_state_sequence[0]
+    # Check for state confirmation
+    if len(sequence) == CONFIRMATION_SEQUENCE_LENGTH and all(s == sequence[0] for s in sequence):
+        if track.last_confirmed_state != sequence[0]: # Compare against the consistent state in the deque
+            track.last_confirmed_state = sequence[0]
             return True # State was just confirmed/changed
     return False # State was not just confirmed/changed
 
 
-def log_state_change(timestamp, determined_state, camera, x, y, frame1, frame2, notes=""):
-    """Log the state change (either from a pair or a timeout) to file and console"""
-    global last_confirmed_state # Access the potentially updated global state here
+def log_state_change(timestamp, determined_state, camera, x, y, frame1, frame2, notes="", track=None):
+    """
+    Log the state change (either from a pair or a timeout) of a TrackState to
+    file and console, with the global confirmed state (what web.py publishes)
+    and the track's own confirmed state in separate columns
+    """
+    if track is None:
+        track = get_track_state(GLOBAL_TRACK)
+    track_confirmed_state = track.last_confirmed_state # The track's confirmed state *after* this event
 
     frames_str = 'TIMEOUT' if frame1 is None else f"{frame1['filename']};{frame2['filename']}"
     camera_val = 'N/A' if camera is None else camera
     x_val = 'N/A' if x is None else f"{x:.4f}"
     y_val = 'N/A' if y is None else f"{y:.4f}"
 
-    # Use pandas to append for potentially better handling of CSV quoting etc.
-    log_df = pd.DataFrame([{
-        'timestamp': timestamp,
-        'state': determined_state if determined_state else 'N/A', # State determined for pair or 'unknown' for timeout
-        'last_confirmed_state': last_confirmed_state, # The global confirmed state *after* this event
-        'camera': camera_val,
-        'x_center': x_val,
-        'y_center': y_val,
-        'frames_used': frames_str,
-        'notes': notes
-    }])
-
-    # Append to CSV without writing header if file already exists
-    try:
-        log_df.to_csv(STATE_LOG_FILE, mode='a', header=False, index=False)
-    except Exception as e:
-        print(f"Error writing to log file {STATE_LOG_FILE}: {e}")
+    # Queue the row for the background writer (csv module handles quoting)
+    start = time.perf_counter()
+    if storage.STORAGE_BACKEND in ("csv", "both"):
+        get_state_log_writer().write_row([
+            timestamp,
+            determined_state if determined_state else 'N/A', # State determined for pair or 'unknown' for timeout
+            last_confirmed_state, # The global confirmed state *after* this event
+            camera_val,
+            x_val,
+            y_val,
+            frames_str,
+            notes,
+            track.track_id,
+            track_confirmed_state
+        ])
+    if storage.STORAGE_BACKEND in ("sqlite", "both"):
+        get_state_store_writer().write_row(storage.state_record(
+            timestamp, determined_state if determined_state else 'N/A', last_confirmed_state, camera, x, y, frames_str, notes,
+            track.track_id, track_confirmed_state
+        ))
+    STATE_LOG_APPEND_SECONDS.observe(time.perf_counter() - start)
+    STATES_LOGGED_TOTAL.inc(state=determined_state if determined_state else 'N/A')
+
+    if not PRINT_STATES:
+        return
 
     # Console output
     timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    if track.track_id != GLOBAL_TRACK:
+        timestamp_str += f" [track {track.track_id}: {track_confirmed_state}]"
     if notes == 'IDLE_TIMEOUT':
-        print(f"{timestamp_str}: --- IDLE TIMEOUT --- Last Confirmed State = {last_confirmed_state} (Set to 'unknown')")
+        print(f"{timestamp_str}: --- IDLE TIMEOUT --- Last Confirmed State = {last_confirmed_state} (Track set to 'unknown')")
     else:
         print(f"{timestamp_str}: Camera {camera_val}, Determined State = {determined_state}, Last Confirmed State = {last_confirmed_state} (Pos: {x_val}, {y_val})")
         if frames_str != 'TIMEOUT':
@@ -172,157 +478,212 @@ def log_state_change(timestamp, determined_state, camera, x, y, frame1, frame2,
     print("") # Add a blank line for readability
 
 
-def monitor_animal_states():
-    """Monitor cat detections and compare sequential pairs of frames"""
-    global last_confirmed_state, global_state_sequence, processed_pair_state_combinations, last_state_relevant_timestamp # Declare globals used in this function
-
-    print("Starting animal state monitor (pairwise sequential mode with global confirmation and idle timeout)...")
-    print("Comparing strictly sequential frame pairs per camera.")
-    print("Only the first processed detection for a given frame pair (e.g., frame N to N+1) *with a specific state* contributes to global state confirmation.")
-    print(f"Global state confirmation requires {CONFIRMATION_SEQUENCE_LENGTH} consecutive states from unique processed sequential pair+state combinations.")
-    print(f"Idle timeout threshold (sets global state to 'unknown'): {IDLE_TIMEOUT_SECONDS} seconds without new state-relevant data.")
-    print(f"Logging to {STATE_LOG_FILE}")
-    print("Press Ctrl+C to stop\n")
-
-    last_processed_timestamp = None # Tracks the timestamp of the most recent row *read* from the CSV
-    last_frame_per_camera = {}  # Stores the last seen frame per camera
-
-
-    try:
-        while True:
-            current_check_time = datetime.now() # Get time at the start of the check
-
-            # --- Idle Timeout Check (before processing new data) ---
-            # Check based on time since the last state-relevant detection
-            if last_state_relevant_timestamp: # Only check if we've ever processed state-relevant data
-                time_since_last_relevant_data = current_check_time - last_state_relevant_timestamp
-
-                if time_since_last_relevant_data.total_seconds() >= IDLE_TIMEOUT_SECONDS:
-                    if last_confirmed_state != "unknown" or len(global_state_sequence) > 0:
-                         # State has been active/resting/sleeping, but now no state-relevant data for timeout period
-                         last_confirmed_state = "unknown"
-                         # Clear global_state_sequence on IDLE_TIMEOUT ---
-                         global_state_sequence.clear() # Clear the deque to ensure fresh confirmation sequence
-                         processed_pair_state_combinations.clear() # Clear processed pairs as well for a truly fresh start
-                         log_state_change(current_check_time, 'unknown', None, None, None, None, None, notes='IDLE_TIMEOUT')
-                         # Corrected comment: log_state_change *logs* the event, but the history clearing (deque, set) is done above.
-                         # log_state_change clears history
-
-
-            # --- Read and Process New Detections ---
-            # Pass last_processed_timestamp to get_cat_detections to only read newer rows
-            animal_detections = get_animal_detections(last_processed_timestamp)
-
+def compute_pair_states(detections, last_frame_per_camera):
+    """
+    Batch version of the per-row pair logic: find strictly sequential frame
+    pairs per camera and compute their movement and state as column operations.
+    detections must be in chronological order. last_frame_per_camera carries the
+    last valid frame of each camera (each camera and track when tracking is on)
+    between checks and is updated in place.
+    Returns one row per pair in chronological order of the pair's end frame.
+    """
+    frames = detections[['timestamp', 'camera', 'filename', 'x_center', 'y_center', 'width', 'height']].copy()
 
-            if not animal_detections.empty:
-                # Sort by timestamp to ensure chronological processing
-                cat_detections.sort_values('timestamp', inplace=True)
+    # Frame index extracted once as an integer column (-1 where it can't be parsed)
+    index = pd.to_numeric(frames['filename'].astype(str).str.split('_', n=1).str[0], errors='coerce')
+    index = index.where(index == index.round())
+    frames['frame_index'] = index.fillna(-1).astype(np.int64)
+    frames = frames[frames['frame_index'] != -1] # Rows without a frame index never pair or become the last frame
 
-                # Update last_processed_timestamp to the timestamp of the latest row found *in this check*
-                # This ensures we don't re-read these rows in the next iteration
-                last_processed_timestamp = animal_detections['timestamp'].iloc[-1]
+    if frames.empty:
+        return pd.DataFrame()
 
+    # Pairs are formed within a track: the same animal on the same camera
+    frames['track'] = tracker.assign(frames) if TRACKING_ENABLED else GLOBAL_TRACK
 
-                # Process new detections in their chronological order
-                for _, detection in cat_detections.iterrows():
-                    camera = detection['camera']
-                    current_frame = {
-                        'timestamp': detection['timestamp'],
-                        'camera': camera,
-                        'x_center': detection['x_center'],
-                        'y_center': detection['y_center'],
-                        'filename': detection['filename']
-                    }
+    # Each track's last frame from previous checks goes first so it can pair with the first new one
+    keys = set(zip(frames['camera'], frames['track']))
+    previous = [frame for key, frame in last_frame_per_camera.items() if key in keys]
+    if previous:
+        frames = pd.concat([pd.DataFrame(previous), frames], ignore_index=True)
+    else:
+        frames = frames.reset_index(drop=True)
+
+    groups = frames.groupby(['camera', 'track'], sort=False)
+    prev = groups[['timestamp', 'frame_index', 'filename', 'x_center', 'y_center']].shift()
+    is_pair = frames['frame_index'] == prev['frame_index'] + 1
+
+    # Remember the last valid frame per track for the next check
+    for frame in groups.tail(1).to_dict('records'):
+        last_frame_per_camera[(frame['camera'], frame['track'])] = frame
+    if TRACKING_ENABLED:
+        live = tracker.live_track_ids()
+        for key in [key for key in last_frame_per_camera if key[1] not in live]:
+            del last_frame_per_camera[key]
+
+    pairs = frames[is_pair].copy()
+    if pairs.empty:
+        return pd.DataFrame()
+    pairs['prev_frame_index'] = prev.loc[is_pair, 'frame_index'].astype(np.int64)
+    pairs['prev_filename'] = prev.loc[is_pair, 'filename']
+
+    # Same maths as calculate_movement/determine_animal_state, for all pairs at once
+    movement = ((pairs['x_center'] - prev.loc[is_pair, 'x_center']).abs() + (pairs['y_center'] - prev.loc[is_pair, 'y_center']).abs()) / 2
+    movement /= pair_seconds(prev.loc[is_pair, 'timestamp'], pairs['timestamp'])
+    passive = pairs['camera'].isin(list(PASSIVE_CAMERAS))
+    active = pairs['camera'].isin(list(ACTIVE_CAMERAS))
+    pairs['state'] = np.select(
+        [passive, active & (movement > MOVEMENT_THRESHOLD), active],
+        ["PASSIVE", "walk", "rest"],
+        default="unknown"
+    )
+    return pairs
+
+def process_detections(animal_detections, last_frame_per_camera):
+    """
+    Compute pair states for a batch of new detections and feed them, in order,
+    through each track's duplicate suppression, confirmation and the state log.
+    """
+    # Sort by timestamp to ensure chronological processing
+    animal_detections = animal_detections.sort_values('timestamp', kind='stable')
+    pairs = compute_pair_states(animal_detections, last_frame_per_camera)
+    if pairs.empty:
+        return
 
-                    current_end_frame_index = get_frame_index_from_filename(current_frame['filename'])
-                    if current_end_frame_index == -1:
-                        # Skip if frame index extraction failed
-                        # print(f"Skipping detection due to invalid filename: {current_frame['filename']}") # Already handled in get_frame_index_from_filename warning
-                        continue # Just skip this row, last_processed_timestamp already updated
+    # Only the confirmation sequence is inherently sequential
+    for pair in pairs.itertuples(index=False):
+        apply_pair_state(pair)
 
 
-                    # Check if we have a previous frame from this camera
-                    if camera in last_frame_per_camera:
-                        prev_frame = last_frame_per_camera[camera]
-                        prev_frame_index = get_frame_index_from_filename(prev_frame['filename'])
+def apply_pair_state(pair):
+    """Feed one row of compute_pair_states through its track's duplicate suppression, confirmation and the state log"""
+    track = get_track_state(pair.track)
+    determined_state = pair.state
 
-                        if prev_frame_index != -1:
-                            # Ensure frames are strictly sequential for THIS camera
-                            if current_end_frame_index == prev_frame_index + 1:
-                                # --- Valid Sequential Pair Found for THIS Camera ---
-                                current_start_frame_index = prev_frame_index
+    # Define the unique combination of pair and state
+    current_pair_state_id = (pair.prev_frame_index, pair.frame_index, determined_state)
 
-                                # Determine the state for this specific sequential pair
-                                determined_state = determine_animal_state(prev_frame, current_frame)
+    notes = ""
 
-                                # Define the unique combination of pair and state
-                                current_pair_state_id = (current_start_frame_index, current_end_frame_index, determined_state)
+    # --- Check for Duplicate Pair+State Combination ---
+    if current_pair_state_id not in track.processed_pairs:
+        # --- Unique Pair+State Combination - Process for Confirmation ---
 
-                                notes = ""
-                                pair_state_processed_for_state = False # Flag to indicate if this combination affects global state/sequence
+        # Add state to sequence and check for confirmation
+        state_just_confirmed = add_state_to_confirmation_sequence(determined_state, track)
+        if state_just_confirmed:
+            notes = (notes + ";" if notes else "") + f"STATE_CONFIRMED={track.last_confirmed_state}"
 
-                                # --- Check for Duplicate Pair+State Combination ---
-                                if current_pair_state_id not in processed_pair_state_combinations:
-                                    # --- Unique Pair+State Combination - Process for Global Confirmation ---
+        # Mark this combination as processed for state determination
+        track.processed_pairs.add(current_pair_state_id)
 
-                                    # Add state to sequence and check for confirmation
-                                    state_just_confirmed = add_state_to_confirmation_sequence(determined_state)
-                                    if state_just_confirmed:
-                                        notes = (notes + ";" if notes else "") + f"STATE_CONFIRMED={last_confirmed_state}"
+        # Update the timestamp of the last state-relevant detection
+        track.last_state_relevant_timestamp = pair.timestamp
+        refresh_last_confirmed_state(track)
 
-                                    # Mark this combination as processed for state determination
-                                    processed_pair_state_combinations.add(current_pair_state_id)
-                                    pair_state_processed_for_state = True # This combination contributed to global state/sequence
+    else:
+        # --- Duplicate Pair+State Combination - Ignore for Global Confirmation ---
+        notes = (notes + ";" if notes else "") + "IGNORED=DUPLICATE_PAIR_AND_STATE"
+        # This does NOT update last_state_relevant_timestamp
+
+    # --- Log the Result ---
+    # Log the determined state for this pair and the *current* global confirmed state
+    log_state_change(
+        pair.timestamp,
+        determined_state, # The state derived from this pair
+        pair.camera,
+        pair.x_center,
+        pair.y_center,
+        {'filename': pair.prev_filename},
+        {'filename': pair.filename},
+        notes, # Pass notes from processing
+        track=track
+    )
+
+
+def check_idle_timeout(current_check_time):
+    """Set a track's state to 'unknown' if no state-relevant data arrived for it for IDLE_TIMEOUT_SECONDS"""
+    for track in list(track_states.values()):
+        # Check based on time since the last state-relevant detection
+        if not track.last_state_relevant_timestamp: # Only check if we've ever processed state-relevant data
+            continue
+        time_since_last_relevant_data = current_check_time - track.last_state_relevant_timestamp
+
+        if time_since_last_relevant_data.total_seconds() >= IDLE_TIMEOUT_SECONDS:
+            if track.last_confirmed_state != "unknown" or len(track.state_sequence) > 0:
+                 # State has been active/resting/sleeping, but now no state-relevant data for timeout period
+                 track.last_confirmed_state = "unknown"
+                 # Clear the state sequence on IDLE_TIMEOUT ---
+                 track.state_sequence.clear() # Clear the deque to ensure fresh confirmation sequence
+                 track.processed_pairs.clear() # Clear processed pairs as well for a truly fresh start
+                 if track.track_id != GLOBAL_TRACK:
+                     # The animal left; a returning one starts a new track (its last frame
+                     # is dropped from last_frame_per_camera once the track isn't live)
+                     del track_states[track.track_id]
+                     tracker.drop(track.track_id)
+                 refresh_last_confirmed_state()
+                 log_state_change(current_check_time, 'unknown', None, None, None, None, None, notes='IDLE_TIMEOUT', track=track)
+                 # Corrected comment: log_state_change *logs* the event, but the history clearing (deque, set) is done above.
 
-                                    # Update the timestamp of the last state-relevant detection
-                                    last_state_relevant_timestamp = current_frame['timestamp']
 
+def monitor_animal_states():
+    """Monitor cat detections and compare sequential pairs of frames"""
+    print("Starting animal state monitor (pairwise sequential mode with global confirmation and idle timeout)...")
+    print("Comparing strictly sequential frame pairs per camera.")
+    print("Only the first processed detection for a given frame pair (e.g., frame N to N+1) *with a specific state* contributes to global state confirmation.")
+    print(f"Global state confirmation requires {CONFIRMATION_SEQUENCE_LENGTH} consecutive states from unique processed sequential pair+state combinations.")
+    print(f"Idle timeout threshold (sets global state to 'unknown'): {IDLE_TIMEOUT_SECONDS} seconds without new state-relevant data.")
+    print(f"Logging to {STATE_LOG_FILE}")
+    print("Press Ctrl+C to stop\n")
 
-                                else:
-                                    # --- Duplicate Pair+State Combination - Ignore for Global Confirmation ---
-                                    notes = (notes + ";" if notes else "") + "IGNORED=DUPLICATE_PAIR_AND_STATE"
-                                    # This does NOT update last_state_relevant_timestamp
+    open_state_log() # Create the state log (with header) before the first state arrives
+    metrics.start_metrics_server(METRICS_PORT)
 
+    last_frame_per_camera = {}  # Stores the last seen frame per camera
 
-                                # --- Log the Result ---
-                                # Log the determined state for this pair and the *current* global confirmed state
-                                log_state_change(
-                                    current_frame['timestamp'],
-                                    determined_state, # The state derived from this pair
-                                    camera,
-                                    current_frame['x_center'],
-                                    current_frame['y_center'],
-                                    prev_frame,
-                                    current_frame,
-                                    notes # Pass notes from processing
-                                )
 
-                            # else: Non-sequential pair found for this camera, skip for state logic
+    try:
+        while True:
+            current_check_time = datetime.now() # Get time at the start of the check
+            tick_start = time.perf_counter()
 
+            # --- Idle Timeout Check (before processing new data) ---
+            check_idle_timeout(current_check_time)
 
-                        # else: No previous frame for this camera, cannot form a sequential pair yet
 
+            # --- Read and Process New Detections ---
+            # Only rows appended since the previous check are read
+            animal_detections = get_animal_detections()
 
-                    # Always update last frame for this camera with the current detection
-                    # This allows the *next* detection for this camera to be checked against this one for sequential pair logic.
-                    last_frame_per_camera[camera] = current_frame
 
+            if not animal_detections.empty:
+                # Pairs are found per camera in one pass, confirmation runs in chronological order
+                process_detections(animal_detections, last_frame_per_camera)
 
-                # End of loop over new_detections
+            TICK_SECONDS.observe(time.perf_counter() - tick_start)
 
+            if day_rollover_due():
+                # Rows the detector wrote to the old day's log since this check come first
+                animal_detections = get_animal_detections()
+                if not animal_detections.empty:
+                    process_detections(animal_detections, last_frame_per_camera)
+                roll_over_day()
 
             # --- End of Loop Iteration ---
-            # If no new detections were found in this check, last_processed_timestamp remains as is from the previous check.
-            # The timeout check at the start of the *next* iteration will use this older timestamp.
+            # The timeout check at the start of the *next* iteration uses last_state_relevant_timestamp.
 
             time.sleep(CHECK_INTERVAL)
 
     except KeyboardInterrupt:
         print("\nMonitoring stopped by user")
+        for track in track_states.values():
+            print(f"Pair dedup set (track {track.track_id}): {track.processed_pairs.stats()}")
     except Exception as e:
         print(f"Error in monitoring: {e}")
         import traceback
         traceback.print_exc() # Print traceback for debugging
+    finally:
+        close_state_log()
 
 if __name__ == "__main__":
     monitor_animal_states()
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import pandas as pd
+from dateutil import tz
+from datetime import datetime, timedelta
+from log_writer import BatchedWriter
+
+# Base directory for the project
+BASE_DIR = "/home/..."
+
+# Which backend DetectionLogger and log_state_change write to: "csv", "sqlite" or "both".
+# The separate-process mode (states.py polling animal.py) needs the detection CSV.
+STORAGE_BACKEND = "csv"
+STORE_FILENAME = "animal_store.sqlite" # One database per {date}_Animal directory
+
+# Typed columns; the (camera, ts) indexes are the time index used by the queries below
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    ts REAL NOT NULL,
+    camera INTEGER NOT NULL,
+    frame_index INTEGER,
+    filename TEXT,
+    object_class TEXT,
+    x_center REAL,
+    y_center REAL,
+    width REAL,
+    height REAL
+);
+CREATE INDEX IF NOT EXISTS detections_camera_ts ON detections (camera, ts);
+CREATE TABLE IF NOT EXISTS states (
+    ts REAL NOT NULL,
+    camera INTEGER,
+    state TEXT,
+    last_confirmed_state TEXT,
+    x_center REAL,
+    y_center REAL,
+    frames_used TEXT,
+    notes TEXT,
+    track INTEGER,
+    track_confirmed_state TEXT
+);
+CREATE INDEX IF NOT EXISTS states_camera_ts ON states (camera, ts);
+CREATE INDEX IF NOT EXISTS states_ts ON states (ts);
+"""
+
+TABLE_COLUMNS = {
+    'detections': ['ts', 'camera', 'frame_index', 'filename', 'object_class', 'x_center', 'y_center', 'width', 'height'],
+    'states': ['ts', 'camera', 'state', 'last_confirmed_state', 'x_center', 'y_center', 'frames_used', 'notes', 'track', 'track_confirmed_state'],
+}
+
+# Columns added after the first version of the schema, added to older databases on connect
+ADDED_COLUMNS = {
+    'detections': [('width', 'REAL'), ('height', 'REAL')],
+    'states': [('track', 'INTEGER'), ('track_confirmed_state', 'TEXT')],
+}
+
+def store_path(day_dir):
+    return os.path.join(day_dir, STORE_FILENAME)
+
+def day_dir_for(day, base_dir=BASE_DIR):
+    return f"{base_dir}/{day.strftime('%Y%m%d')}_Animal"
+
+def to_epoch(timestamp):
+    """Seconds since the epoch for an ISO string, datetime or pandas Timestamp (naive = local time)"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    elif isinstance(timestamp, pd.Timestamp):
+        timestamp = timestamp.to_pydatetime() # Timestamp.timestamp() would treat naive values as UTC
+    return timestamp.timestamp()
+
+def frame_index_from_filename(filename):
+    # Same "123_cameraX_..." convention as states.get_frame_index_from_filename
+    try:
+        return int(str(filename).split('_')[0])
+    except ValueError:
+        return None
+
+def detection_record(row):
+    """Convert a detection log row (DETECTION_LOG_HEADER order) to a detections table row"""
+    timestamp, camera, filename, object_class, x_center, y_center, width, height = row
+    return (to_epoch(timestamp), int(camera), frame_index_from_filename(filename), filename, object_class,
+            float(x_center), float(y_center), float(width), float(height))
+
+def state_record(timestamp, state, last_confirmed_state, camera, x, y, frames_used, notes, track=None, track_confirmed_state=None):
+    """Build a states table row; camera, x and y may be None (e.g. for an idle timeout)"""
+    return (
+        to_epoch(timestamp),
+        None if camera is None else int(camera),
+        state,
+        last_confirmed_state,
+        None if x is None else float(x),
+        None if y is None else float(y),
+        frames_used,
+        notes,
+        track,
+        track_confirmed_state,
+    )
+
+def connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer
+    connection.executescript(SCHEMA)
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+        for name, kind in columns:
+            if name not in existing:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind}")
+    return connection
+
+class SqliteBatchWriter(BatchedWriter):
+    """Appends rows to one table of a day's database, one transaction per batch"""
+    def __init__(self, path, table, **kwargs):
+        super().__init__(path, **kwargs)
+        self.table = table
+        columns = TABLE_COLUMNS[table]
+        self.insert_sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        self.connection = connect(path)
+        # Durability is handled by the fsync policy through the synchronous pragma
+        self.connection.execute("PRAGMA synchronous=OFF" if self.fsync_policy == "never" else "PRAGMA synchronous=NORMAL")
+        self.thread.start()
+
+    def _write(self, rows):
+        try:
+            with self.connection:
+                self.connection.executemany(self.insert_sql, rows)
+        except Exception as e:
+            print(f"Error writing to {self.table} in {self.path}: {e}")
+
+    def _fsync(self):
+        try:
+            self.connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except Exception as e:
+            print(f"Error checkpointing {self.path}: {e}")
+
+    def _close_output(self):
+        self.connection.close()
+
+def _query(table, start, end, camera=None, base_dir=BASE_DIR):
+    """Read rows between start and end, opening only the day databases in that range"""
+    columns = ', '.join(TABLE_COLUMNS[table])
+    sql = f"SELECT {columns} FROM {table} WHERE ts >= ? AND ts <= ?"
+    params = [to_epoch(start), to_epoch(end)]
+    if camera is not None:
+        sql += " AND camera = ?"
+        params.append(int(camera))
+    sql += " ORDER BY ts"
+
+    frames = []
+    day = pd.Timestamp(start).normalize()
+    while day <= pd.Timestamp(end):
+        path = store_path(day_dir_for(day, base_dir))
+        if os.path.exists(path):
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                frames.append(pd.read_sql_query(sql, connection, params=params))
+            finally:
+                connection.close()
+        day += timedelta(days=1)
+
+    if not frames:
+        frames.append(pd.DataFrame(columns=TABLE_COLUMNS[table]).astype({'ts': float})) # Same columns as a result with rows
+    df = pd.concat(frames, ignore_index=True)
+    # Back to naive local time, like the timestamps in the CSV logs
+    df['timestamp'] = pd.to_datetime(df['ts'], unit='s', utc=True).dt.tz_convert(tz.tzlocal()).dt.tz_localize(None)
+    return df
+
+def query_detections(camera, start, end, base_dir=BASE_DIR):
+    """Detections for one camera (or all with camera=None) between start and end"""
+    return _query('detections', start, end, camera, base_dir)
+
+def query_states(start, end, camera=None, base_dir=BASE_DIR):
+    """State log rows between start and end, optionally for one camera"""
+    return _query('states', start, end, camera, base_dir)
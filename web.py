@@ -1,8 +1,13 @@
-import sys, time, json, ssl
+import sys, time, json, ssl, csv
 import requests, threading
 import os
+import asyncio
+from collections import deque
 from datetime import datetime
 from websockets.sync.client import connect as websocket_connect
+from websockets.asyncio.server import serve as websocket_serve
+from websockets.exceptions import ConnectionClosed
+import metrics
 
 # Base directory for the project
 BASE_DIR = "/home/..."
@@ -14,53 +19,331 @@ MAIN_DIR = f"{BASE_DIR}/{DATE_STR}_Animal"
 PROCESS_INTERVAL = 1  # in seconds
 STATE_LOG = os.path.join(MAIN_DIR, 'animal_states_log.csv') # Path to state log
 ANIMAL_NAME = 'animal'  # animal name, can be changed via command line
+WEBSOCKET_URL = "wss://..."  # remote endpoint every state change is pushed to, None to only serve locally
+RECONNECT_MIN_DELAY = 1  # seconds before the first reconnect attempt, doubled after each failure
+RECONNECT_MAX_DELAY = 60  # upper bound for the reconnect delay
+TAIL_BLOCK_SIZE = 1024  # bytes read per step when seeking back from the end of the log
+METRICS_PORT = 9110  # local Prometheus endpoint (/metrics) for this process, None to disable
+# Local WebSocket server for dashboards: clients get a snapshot (latest state per animal and camera,
+# recent updates) on connect, then every update once
+SERVER_PORT = None  # e.g. 8765 to serve ws://SERVER_HOST:SERVER_PORT, None to disable
+SERVER_HOST = "0.0.0.0"
+SERVER_HISTORY_SIZE = 100  # recent updates kept and sent with the snapshot
+SERVER_CLIENT_QUEUE_SIZE = 64  # updates buffered per client; a client this far behind is disconnected
+SERVER_CLOSE_CODE_TOO_SLOW = 1013  # "try again later", sent to dropped clients
+SERVER_CLOSE_TIMEOUT = 1  # seconds to wait for a client to acknowledge a close before the connection is cut
 
-def get_last_animal_state():
+SEND_SECONDS = metrics.Histogram("web_send_seconds", "Time to send one state update, including connecting")
+SEND_FAILURES_TOTAL = metrics.Counter("web_send_failures_total", "Failed sends (each one drops the connection)")
+CONNECTS_TOTAL = metrics.Counter("web_connects_total", "WebSocket connections opened")
+SERVER_CLIENTS = metrics.Gauge("web_server_clients", "Dashboard clients connected to the local server")
+SERVER_UPDATES_TOTAL = metrics.Counter("web_server_updates_total", "Updates broadcast by the local server")
+SERVER_CLIENTS_DROPPED_TOTAL = metrics.Counter("web_server_clients_dropped_total", "Clients disconnected for falling behind")
+
+def read_last_line(path, block_size=TAIL_BLOCK_SIZE):
+    """Return the last complete line of a file, reading backwards from the end"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            # Stop once the block holds a newline before the last complete line
+            if data.count(b'\n') >= 2 or (pos == 0 and b'\n' in data):
+                break
+
+    # A trailing line without a newline is still being written, ignore it
+    complete = data[:data.rfind(b'\n') + 1]
+    lines = complete.splitlines()
+    if not lines:
+        return None
+    return lines[-1].decode(errors='replace')
+
+def check_day_rollover():
+    """Follow the state log into the new day's directory after midnight"""
+    global DATE_STR, MAIN_DIR, STATE_LOG
+    date_str = datetime.now().strftime("%Y%m%d")
+    if date_str != DATE_STR:
+        DATE_STR = date_str
+        MAIN_DIR = f"{BASE_DIR}/{DATE_STR}_Animal"
+        STATE_LOG = os.path.join(MAIN_DIR, 'animal_states_log.csv')
+        print(f"New day: reading {STATE_LOG}")
+
+def get_last_state_row():
+    """Fields of the last state log row (timestamp, state, last_confirmed_state, camera, ...), or None"""
     try:
-        with open(STATE_LOG, 'r') as f:
-            lines = f.readlines()
-            if not lines:
-                return None
+        last_line = read_last_line(STATE_LOG)
+        if last_line is None:
+            return None
             
-            # Get last line and extract state
-            last_line = lines[-1].strip()
-            if not last_line:
-                return None
-                
-            parts = last_line.split(',')
-            if len(parts) >= 3:
-                return parts[2]  # Return the state from second column
+        # Get last line and split it into fields
+        last_line = last_line.strip()
+        if not last_line or last_line.startswith('timestamp,'): # Empty or only the header so far
+            return None
+            
+        parts = next(csv.reader([last_line]))
+        if len(parts) >= 3:
+            return parts
+    except FileNotFoundError:
+        pass # The state monitor hasn't created today's log yet
     except Exception as e:
         print(f"Error reading animal state log: {e}")
     
     return None
 
 
-def send_websocket_request(data):
-    try:
-        with websocket_connect("wss://...", ssl=ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)) as websocket:
-            websocket.send(json.dumps(data))
-    except Exception as e:
-        print(f"An error occurred: {e}")
+class StatePublisher:
+    """
+    Sends state updates over one long-lived WebSocket connection.
+    Updates are coalesced: if several arrive while a send or reconnect is in
+    progress only the newest is sent. A failed send drops the connection and
+    retries with exponential backoff.
+    """
+    def __init__(self, url=WEBSOCKET_URL):
+        self.url = url
+        self.pending = None
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="state-publisher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify()
+        self.thread.join()
+
+    def publish(self, data):
+        """Queue data to send, replacing any update that hasn't been sent yet"""
+        with self.condition:
+            self.pending = data
+            self.condition.notify()
+
+    def _take_pending(self):
+        with self.condition:
+            data, self.pending = self.pending, None
+            return data
+
+    def _run(self):
+        websocket = None
+        delay = RECONNECT_MIN_DELAY
+        data = None
+        while not self.stopped.is_set():
+            with self.condition:
+                while self.pending is None and data is None and not self.stopped.is_set():
+                    self.condition.wait()
+            data = self._take_pending() or data
+            if data is None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                if websocket is None:
+                    websocket = websocket_connect(self.url, ssl=ssl.SSLContext(ssl.PROTOCOL_TLSv1_2))
+                    CONNECTS_TOTAL.inc()
+                websocket.send(json.dumps(data))
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                data = None
+                delay = RECONNECT_MIN_DELAY
+            except Exception as e:
+                SEND_FAILURES_TOTAL.inc()
+                print(f"An error occurred: {e} (reconnecting in {delay}s)")
+                if websocket is not None:
+                    try:
+                        websocket.close()
+                    except Exception:
+                        pass
+                    websocket = None
+                # Keep the unsent update; a newer one published meanwhile replaces it
+                self.stopped.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        if websocket is not None:
+            websocket.close()
+
+class StateServer:
+    """
+    Local WebSocket server for any number of dashboards, run on an asyncio
+    loop in its own thread. It keeps the latest state per animal and per
+    camera and the last SERVER_HISTORY_SIZE updates. A new client gets all
+    of that as one snapshot, then every update once; each update is encoded
+    once and put on every client's bounded queue. A client whose queue is
+    full is disconnected instead of holding up the others.
+    Same publish() interface as StatePublisher.
+    """
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, history_size=SERVER_HISTORY_SIZE,
+                 client_queue_size=SERVER_CLIENT_QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.client_queue_size = client_queue_size
+        # Only touched on the loop thread
+        self.animals = {} # animal -> confirmed state
+        self.cameras = {} # camera -> {'state', 'timestamp'} of its latest row
+        self.history = deque(maxlen=history_size)
+        self.clients = {} # websocket -> asyncio.Queue of encoded updates
+        self.disconnecting = set() # Close tasks of dropped clients
+        self.loop = None
+        self.stopping = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="state-server", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
+
+    def publish(self, data):
+        """{animal: state} like StatePublisher"""
+        for animal, state in data.items():
+            self.update(animal, state)
+
+    def update(self, animal, state, camera=None, camera_state=None, timestamp=None):
+        """Record a state (thread-safe); clients only hear about it if something changed"""
+        loop = self.loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._apply, animal, state, camera, camera_state, timestamp)
+        except RuntimeError:
+            pass # Loop already closed
+
+    def snapshot(self):
+        return {'type': 'snapshot', 'animals': dict(self.animals), 'cameras': dict(self.cameras), 'history': list(self.history)}
+
+    def _apply(self, animal, state, camera, camera_state, timestamp):
+        changed = self.animals.get(animal) != state
+        self.animals[animal] = state
+        if camera:
+            entry = {'state': camera_state, 'timestamp': timestamp}
+            changed = changed or self.cameras.get(camera, {}).get('state') != camera_state
+            self.cameras[camera] = entry
+        if not changed:
+            return
+        update = {'type': 'update', 'animal': animal, 'state': state, 'camera': camera,
+                  'camera_state': camera_state, 'timestamp': timestamp}
+        self.history.append(update)
+        SERVER_UPDATES_TOTAL.inc()
+        message = json.dumps(update)
+        for websocket, client in list(self.clients.items()):
+            try:
+                client.put_nowait(message)
+            except asyncio.QueueFull:
+                self._drop(websocket)
+
+    def _drop(self, websocket):
+        self.clients.pop(websocket)
+        SERVER_CLIENTS.set(len(self.clients))
+        SERVER_CLIENTS_DROPPED_TOTAL.inc()
+        task = asyncio.ensure_future(self._disconnect(websocket))
+        self.disconnecting.add(task)
+        task.add_done_callback(self.disconnecting.discard)
+
+    async def _disconnect(self, websocket):
+        """Close a dropped client's connection, or cut it if the close frame can't get past its full buffers"""
+        try:
+            await asyncio.wait_for(websocket.close(SERVER_CLOSE_CODE_TOO_SLOW, "client too slow"), SERVER_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            websocket.transport.abort()
+
+    async def _handler(self, websocket):
+        # Registered and snapshotted without an await in between, so no update is missed or sent twice
+        client = asyncio.Queue(maxsize=self.client_queue_size)
+        self.clients[websocket] = client
+        SERVER_CLIENTS.set(len(self.clients))
+        closed = asyncio.ensure_future(websocket.wait_closed())
+        try:
+            await websocket.send(json.dumps(self.snapshot()))
+            while True:
+                get = asyncio.ensure_future(client.get())
+                done, _ = await asyncio.wait({get, closed}, return_when=asyncio.FIRST_COMPLETED)
+                if get not in done:
+                    get.cancel()
+                    break # Client went away, or was dropped
+                await websocket.send(get.result())
+        except ConnectionClosed:
+            pass
+        finally:
+            closed.cancel()
+            if self.clients.pop(websocket, None) is not None:
+                SERVER_CLIENTS.set(len(self.clients))
+
+    async def _serve(self):
+        self.stopping = asyncio.Event()
+        try:
+            async with websocket_serve(self._handler, self.host, self.port, close_timeout=SERVER_CLOSE_TIMEOUT):
+                self.loop = asyncio.get_running_loop()
+                print(f"Serving states on ws://{self.host}:{self.port}")
+                self.ready.set()
+                await self.stopping.wait()
+        except OSError as e:
+            print(f"Could not start state server on {self.host}:{self.port}: {e}")
+        finally:
+            self.loop = None
+            self.ready.set()
+
+    def _run(self):
+        asyncio.run(self._serve())
+
+def start_publishers():
+    """The remote publisher (WEBSOCKET_URL) and the local server (SERVER_PORT), whichever are configured"""
+    publishers = []
+    if WEBSOCKET_URL:
+        publishers.append(StatePublisher())
+    if SERVER_PORT:
+        publishers.append(StateServer())
+    for publisher in publishers:
+        publisher.start()
+    return publishers
 
 def main(process_interval=PROCESS_INTERVAL, animal_name=ANIMAL_NAME):
-    while True:
-        # Get the last animal state
-        animal_state = get_last_animal_state()
-        
-        if animal_state is not None:
-            # Prepare data to send
-            data = {
-                animal_name: animal_state
-            }
+    metrics.start_metrics_server(METRICS_PORT)
+    publishers = start_publishers()
+    server = next((publisher for publisher in publishers if isinstance(publisher, StateServer)), None)
+    last_sent_state = None
+    last_row = None
+    
+    try:
+        while True:
+            check_day_rollover()
             
-            # Send via WebSocket in a separate thread
-            thread = threading.Thread(target=send_websocket_request, args=(data,))
-            thread.start()
+            # Get the last state row; only its confirmed state goes to the remote endpoint
+            row = get_last_state_row()
+            animal_state = None if row is None else row[2]
+            
+            if server is not None and row is not None and row != last_row:
+                # Dashboards also get the state seen on each camera
+                camera = row[3] if len(row) > 3 and row[3] else None
+                server.update(animal_name, animal_state, camera=camera, camera_state=row[1], timestamp=row[0])
+            last_row = row
+            
+            # Only push when the confirmed state actually changes
+            if animal_state is not None and animal_state != last_sent_state:
+                # Prepare data to send
+                data = {
+                    animal_name: animal_state
+                }
+                
+                for publisher in publishers:
+                    if publisher is not server:
+                        publisher.publish(data)
+                last_sent_state = animal_state
+                
+                print(f"{animal_name} - {animal_state}")
             
-            print(f"{animal_name} - {animal_state}")
-        
-        time.sleep(process_interval)
+            time.sleep(process_interval)
+    finally:
+        for publisher in publishers:
+            publisher.stop()
 
 if __name__ == "__main__":
     process_interval = int(sys.argv[1]) if len(sys.argv) > 1 else PROCESS_INTERVAL